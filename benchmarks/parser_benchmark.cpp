@@ -0,0 +1,84 @@
+// Parsing speed of filereader, in lines per second.
+//
+// Compile and run from the top Chochin directory with
+//   g++ -std=c++11 -O2 -pthread benchmarks/parser_benchmark.cpp -o parser_benchmark -lz
+//   ./parser_benchmark [file] [line_nb] [threads]
+// A Yaplot file with line_nb lines (10M by default) is generated first
+// if file does not exist.
+
+#include "../filereader.cpp"
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <random>
+
+static void generate(const std::string &fname, long line_nb) {
+  std::ofstream out(fname.c_str());
+  std::mt19937 gen(1);
+  std::uniform_real_distribution<double> x(-100, 100);
+  std::uniform_real_distribution<double> u(0, 1);
+  const long frame_size = 100000;
+  char buf[256];
+  for (long i = 1; i <= line_nb; i++) {
+    if (i % frame_size == 0) {
+      out << "\n";
+      continue;
+    }
+    double r = u(gen);
+    if (r < 0.01) {
+      snprintf(buf, sizeof(buf), "y %d\n", 1 + static_cast<int>(12*u(gen)));
+    } else if (r < 0.02) {
+      snprintf(buf, sizeof(buf), "@ %d\n", static_cast<int>(20*u(gen)));
+    } else if (r < 0.03) {
+      snprintf(buf, sizeof(buf), "@ %.3f %.3f %.3f\n", u(gen), u(gen), u(gen));
+    } else if (r < 0.04) {
+      snprintf(buf, sizeof(buf), "r %.3f\n", 2*u(gen));
+    } else if (r < 0.6) {
+      snprintf(buf, sizeof(buf), "c %.6f %.6f %.6f\n", x(gen), x(gen), x(gen));
+    } else if (r < 0.85) {
+      snprintf(buf, sizeof(buf), "s %.6f %.6f %.6f %.6f %.6f %.6f\n",
+               x(gen), x(gen), x(gen), x(gen), x(gen), x(gen));
+    } else if (r < 0.95) {
+      snprintf(buf, sizeof(buf), "l %.6f %.6f %.6f %.6f %.6f %.6f\n",
+               x(gen), x(gen), x(gen), x(gen), x(gen), x(gen));
+    } else {
+      snprintf(buf, sizeof(buf), "t %.6f %.6f %.6f label %ld\n",
+               x(gen), x(gen), x(gen), i);
+    }
+    out << buf;
+  }
+}
+
+int main(int argc, char **argv) {
+  std::string fname = argc > 1 ? argv[1] : "parser_benchmark.yap";
+  long line_nb = argc > 2 ? atol(argv[2]) : 10000000;
+  unsigned threads = argc > 3 ? atoi(argv[3]) : 1;
+
+  if (!std::ifstream(fname.c_str()).good()) {
+    std::cout << "generating " << fname << " (" << line_nb << " lines)" << std::endl;
+    generate(fname, line_nb);
+  }
+  long lines = 0;
+  {
+    std::ifstream in(fname.c_str());
+    for (std::string line; std::getline(in, line); ) {
+      lines++;
+    }
+  }
+  std::remove((fname + ".chidx").c_str());
+
+  filereader reader(fname);
+
+  auto t0 = std::chrono::steady_clock::now();
+  reader.index();
+  auto t1 = std::chrono::steady_clock::now();
+  reader.load(0, reader.frameNumber(), threads);
+  auto t2 = std::chrono::steady_clock::now();
+
+  double index_time = std::chrono::duration<double>(t1 - t0).count();
+  double parse_time = std::chrono::duration<double>(t2 - t1).count();
+  printf("%ld lines, %zu frames, %u thread(s)\n", lines, reader.frameNumber(), threads);
+  printf("index: %8.3f s  %12.0f lines/s\n", index_time, lines/index_time);
+  printf("parse: %8.3f s  %12.0f lines/s\n", parse_time, lines/parse_time);
+  return 0;
+}
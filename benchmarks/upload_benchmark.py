@@ -0,0 +1,69 @@
+# Time to upload the vertex data of a frame to the GPU, in ms per frame,
+# with a new VBO per frame (as chochin used to do) and with the
+# StreamBuffer kept across frames.
+#
+# Run from the top Chochin directory with
+#   python benchmarks/upload_benchmark.py [stick_nb] [frame_nb]
+# Frames of stick_nb random sticks (100000 by default) are uploaded
+# frame_nb times (200 by default).
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+# first, as it has OpenGL use EGL, without any display
+import chochinRender as cRender
+import chochinPrimitives as cPrim
+
+import OpenGL.GL as gl
+import OpenGL.arrays.vbo as glvbo
+
+
+def make_frames(stick_nb, frame_nb=4):
+    rng = np.random.RandomState(1)
+    frames = []
+    for i in range(frame_nb):
+        # frames of slightly different sizes, as in a real trajectory
+        n = stick_nb - i*(stick_nb//100)
+        frames.append(cPrim.Sticks.vbo_data(
+            rng.uniform(-1, 1, (n, 6)).astype(np.float32),
+            rng.uniform(0, 0.1, n).astype(np.float32),
+            rng.randint(0, 20, n).astype(np.uint16)))
+    return frames
+
+
+def upload_new_vbo(frames, frame_nb):
+    for i in range(frame_nb):
+        vbo = glvbo.VBO(frames[i % len(frames)], usage='GL_STATIC_DRAW_ARB')
+        vbo.bind()   # the data are uploaded here
+        vbo.unbind()
+    gl.glFinish()
+
+
+def upload_stream_buffer(frames, frame_nb):
+    buf = cPrim.StreamBuffer()
+    for i in range(frame_nb):
+        buf.set_data(frames[i % len(frames)])
+    gl.glFinish()
+
+
+if __name__ == '__main__':
+    stick_nb = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    frame_nb = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    # as the headless renderer does; raises without a context
+    context = cRender.eglContext()
+
+    frames = make_frames(stick_nb)
+    mbytes = frames[0].nbytes/2.**20
+    print("{} sticks, {:.1f} MB per frame".format(stick_nb, mbytes))
+    for name, upload in [("new VBO", upload_new_vbo),
+                         ("stream buffer", upload_stream_buffer)]:
+        upload(frames, 4)   # warm up
+        start = time.time()
+        upload(frames, frame_nb)
+        elapsed = (time.time() - start)/frame_nb
+        print("{:14s} {:8.3f} ms/frame  {:8.1f} MB/s".format(
+            name, 1e3*elapsed, mbytes/elapsed))
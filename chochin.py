@@ -20,8 +20,6 @@
 # PyQt5 imports
 from PyQt5 import QtGui, QtCore, QtWidgets, Qt
 
-import chochinCanvas as cCanvas
-
 
 class SceneInfoWidget(QtWidgets.QWidget):
     frame_info_box = QtCore.QRectF(15, 10, 120, 18)
@@ -90,12 +88,13 @@ class SceneInfoWidget(QtWidgets.QWidget):
 
 if __name__ == '__main__':
     import sys
+    import argparse
 
     class ChochinWindow(QtWidgets.QMainWindow):
         verbosity = True
         timer = QtCore.QBasicTimer()
 
-        def __init__(self, filename):
+        def __init__(self, filename, threads=None, follow=False):
             super(ChochinWindow, self).__init__()
 
             # initialize the GL widget
@@ -109,9 +108,16 @@ if __name__ == '__main__':
 
             self.scene_info_widget = SceneInfoWidget(self, 180, 120)
             self.show()
-            self.datawidget.setFile(filename)
+            self.datawidget.setFile(filename, threads, follow)
             self.datawidget.readFileAndDisplay()
             self.setInfoWidget()
+            if follow:
+                self.datawidget.frames_added.connect(self.showNewFrames)
+
+        def showNewFrames(self, former_frame_nb):
+            if self.verbosity:
+                self.setInfoWidget()
+                self.scene_info_widget.update()
 
         def setInfoWidget(self):
             layers = self.datawidget.layer_activity
@@ -143,12 +149,73 @@ if __name__ == '__main__':
                 self.setInfoWidget()
                 self.scene_info_widget.update()
 
-    if len(sys.argv) < 2:
-        print("Usage:\n chochin.py input_file")
-        exit(1)
+    parser = argparse.ArgumentParser(prog="chochin.py")
+    parser.add_argument("input_file",
+                        help="yaplot file, or - for the standard input")
+    parser.add_argument("-j", "--threads", type=int,
+                        help="load the whole file at start, "
+                             "parsing with THREADS threads "
+                             "(by default frames are parsed when displayed)")
+    parser.add_argument("-f", "--follow", action="store_true",
+                        help="keep reading frames as they are appended "
+                             "to the file (or written to the pipe), "
+                             "staying on the last frame")
+    render = parser.add_argument_group(
+        "rendering without display",
+        "render frames offscreen to image files and/or to a video encoder, "
+        "without opening a window")
+    render.add_argument("--render", metavar="PATTERN",
+                        help="write frame i to the image file PATTERN %% i, "
+                             "e.g. out_%%05d.png")
+    render.add_argument("--pipe", metavar="COMMAND",
+                        help="write frames as raw rgb24 data to the "
+                             "standard input of the shell command COMMAND, "
+                             "in which {width} and {height} are replaced "
+                             "by the image size")
+    render.add_argument("--frames", default=":",
+                        help="frames to render, as first:last:step "
+                             "(a Python slice, frames counted from 0)")
+    render.add_argument("--size", default="800x800",
+                        help="image size, as WIDTHxHEIGHT")
+    render.add_argument("--processes", type=int, default=1,
+                        help="render with PROCESSES processes in parallel")
+    args = parser.parse_args()
+
+    # OpenGL is imported with the canvas, for rendering through EGL
+    # (see chochinRender) or for the window
+    if args.render is not None or args.pipe is not None:
+        import chochinRender as cRender
+
+        try:
+            width, height = [int(n) for n in args.size.split("x")]
+            pipe = args.pipe
+            if pipe is not None:
+                pipe = pipe.format(width=width, height=height)
+            if args.processes > 1:
+                if args.threads is not None:
+                    print("[chochin] -j is ignored with --processes, "
+                          "frames are parsed by the processes")
+                cRender.renderFramesInParallel(args.input_file,
+                                               width, height,
+                                               args.frames, args.render,
+                                               pipe, args.processes)
+            else:
+                app = QtGui.QGuiApplication(sys.argv)
+                renderer = cRender.OffscreenRenderer(width, height)
+                renderer.setFile(args.input_file, args.threads)
+                renderer.readFile()
+                frames = cRender.frameRange(args.frames,
+                                            renderer.data.frame_nb())
+                cRender.renderFrames(renderer, frames, args.render, pipe)
+        except (RuntimeError, ValueError) as e:
+            print(e)
+            exit(1)
+        exit(0)
+
+    import chochinCanvas as cCanvas
     app = QtWidgets.QApplication(sys.argv)
     try:
-        window = ChochinWindow(sys.argv[1])
+        window = ChochinWindow(args.input_file, args.threads, args.follow)
         app.exec_()
     except RuntimeError as e:
         print(e)
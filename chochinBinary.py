@@ -0,0 +1,183 @@
+#    Copyright 2016 Romain Mari
+#    This file is part of Chochin.
+#
+#    Chochin is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Binary Chochin files (.chb), holding frames as parsed from a Yaplot
+# file, so that they can be used without parsing.
+#
+# All numbers are little-endian. The file starts with a header:
+#   magic "CHOCHINB", uint32 version, uint32 explicit color number,
+#   uint64 frame number, uint64 offset of the frame table
+# followed by the frames, the frame table: for each frame,
+#   uint64 offset of the frame, uint32 object number of each type
+#   (circles, sticks, lines, texts),
+# and the explicit colors, as uint8 rgba.
+# A frame starts at a multiple of 8 bytes, and holds, for each object
+# type with objects:
+#   float32 positions (3 or 6 per object), float32 radii (circles and
+#   sticks), uint16 color codes (as given by chochinFile), uint8
+#   layers, zeros up to a multiple of 4 bytes,
+# and for texts, uint32 offsets of the labels in the UTF-8 label data
+# (one per text, plus the end), then the label data, zeros up to a
+# multiple of 4 bytes.
+
+import os
+import mmap
+import struct
+import numpy as np
+
+import chochinScene
+
+magic = b"CHOCHINB"
+version = 2
+header = struct.Struct("<8sIIQQ")
+table_dtype = np.dtype([("offset", "<u8"), ("count", "<u4", (4,))])
+
+object_types = ("c", "s", "l", "t")
+object_dims = (3, 6, 6, 3)
+
+
+def isBinaryFile(fname):
+    if not os.path.isfile(fname):
+        return False
+    with open(fname, "rb") as f:
+        return f.read(len(magic)) == magic
+
+
+class chochinBinaryFile:
+    """Frames of a binary Chochin file. The file is memory-mapped, so
+    that frames are reached in constant time, as read-only NumPy views
+    on the file. Same interface as chochinFile."""
+
+    def __init__(self, fname):
+        with open(fname, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, file_version, color_nb, frame_nb, table_offset =\
+            header.unpack_from(self.map, 0)
+        if file_magic != magic or file_version != version:
+            raise RuntimeError("Unsupported binary file version.")
+        self.table, offset = self.view(table_offset, table_dtype, frame_nb)
+        colors, _ = self.view(offset, np.uint8, 4*color_nb)
+        self.colors = colors.reshape((color_nb, 4))
+
+    def buildIndex(self):
+        """Nothing to do, the frame table is in the file."""
+        pass
+
+    def readChunk(self):
+        pass
+
+    def setCacheSize(self, size):
+        pass
+
+    def color_table(self, first=0):
+        return self.colors[first:]
+
+    def update(self):
+        return 0
+
+    def at_end(self):
+        return True
+
+    def view(self, offset, dtype, count):
+        """Array of count dtype items at offset, and the offset after it."""
+        a = np.frombuffer(self.map, dtype=dtype, count=count, offset=offset)
+        return a, offset + a.nbytes
+
+    def __getitem__(self, index):
+        """Positions and attributes of the objects of a frame, as given
+        by chochinFile."""
+        if not 0 <= index < len(self.table):
+            raise IndexError("Frame index out of range.")
+        offset = int(self.table["offset"][index])
+        counts = self.table["count"][index]
+        pos = {}
+        attrs = {}
+        for k, o in enumerate(object_types):
+            n = int(counts[k])
+            if n == 0:
+                continue
+            p, offset = self.view(offset, "<f4", object_dims[k]*n)
+            pos[o] = p.reshape((n, object_dims[k]))
+            attrs[o] = {}
+            if o == "c" or o == "s":
+                attrs[o]['r'], offset = self.view(offset, "<f4", n)
+            attrs[o]['@'], offset = self.view(offset, "<u2", n)
+            attrs[o]['y'], offset = self.view(offset, np.uint8, n)
+            offset += -offset % 4
+            if o == "t":
+                label_offsets, offset = self.view(offset, "<u4", n+1)
+                text, offset = self.view(offset, np.uint8,
+                                         int(label_offsets[-1]))
+                attrs[o]['s'] = chochinScene.Labels(text, label_offsets)
+                offset += -offset % 4
+
+        return pos, attrs
+
+    def bounds(self, index):
+        """Not stored, chochinScene computes them from the positions."""
+        return None
+
+    def get_attrs(self, index):
+        return self[index][1]
+
+    def frame_nb(self):
+        return len(self.table)
+
+
+def writeArray(out, a, dtype):
+    out.write(np.ascontiguousarray(a, dtype=dtype).tobytes())
+
+
+def pad(out, alignment):
+    out.write(b"\0"*(-out.tell() % alignment))
+
+
+def convert(data, out_name):
+    """Write the frames of data (a chochinFile, indexed) to the binary
+    file out_name."""
+    frame_nb = data.frame_nb()
+    table = np.zeros(frame_nb, dtype=table_dtype)
+    with open(out_name, "wb") as out:
+        out.write(header.pack(magic, version, 0, 0, 0))
+        for i in range(frame_nb):
+            pad(out, 8)
+            table["offset"][i] = out.tell()
+            pos, attrs = data[i]
+            for k, o in enumerate(object_types):
+                if o not in pos:
+                    continue
+                table["count"][i, k] = len(pos[o])
+                writeArray(out, pos[o], "<f4")
+                if o == "c" or o == "s":
+                    writeArray(out, attrs[o]['r'], "<f4")
+                writeArray(out, attrs[o]['@'], "<u2")
+                writeArray(out, attrs[o]['y'], np.uint8)
+                pad(out, 4)
+                if o == "t":
+                    labels = attrs[o]['s']
+                    writeArray(out, labels.offsets, "<u4")
+                    writeArray(out, labels.text, np.uint8)
+                    pad(out, 4)
+        pad(out, 8)
+        table_offset = out.tell()
+        out.write(table.tobytes())
+        # all frames were parsed, so the color table is complete
+        colors = data.color_table()
+        writeArray(out, colors, np.uint8)
+        out.seek(0)
+        out.write(header.pack(magic, version, len(colors), frame_nb,
+                              table_offset))
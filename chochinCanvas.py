@@ -17,6 +17,8 @@
 
 import sys
 import os
+import time
+import threading
 import numpy as np
 
 # PyQt5 imports
@@ -28,6 +30,9 @@ import OpenGL.GL as gl
 import chochinPrimitives as cPrim
 import chochinFile as cFile
 import chochinScene as cScene
+import chochinPlayback as cPlayback
+import chochinText as cText
+import chochinGrid as cGrid
 
 color_fname = "chochin_palette.py"
 if os.path.isfile(color_fname):
@@ -68,26 +73,30 @@ for c in color_palette:
 color_palette = np.array(p)
 
 
-class ChochinCanvas(QGLWidget):
+class ChochinView(object):
+    """Display of the frames of a file with OpenGL, whatever the
+    surface it is drawn on: geometry, scene preparation and painting."""
     width, height = 600, 600
-    speed = 10
-    forward_anim = True
     frame = 0
     former_frame = 0
     init_offset = [0, 0]
-    prefactor = ""
+    scene = None
+    object_types = []
+    cache_size = 256*2**20  # bytes, for parsed and for prepared frames
+    grid_size = 16  # cells per side of the grids culling the objects
+    lod_size = 2    # pixels, below which objects are drawn coarsely
 
-    def __init__(self, parent=None):
-        QtOpenGL.QGLWidget.__init__(
-            self, QtOpenGL.QGLFormat(QtOpenGL.QGL.SampleBuffers), parent)
-        self.installEventFilter(self)
+    def __init__(self):
         self.layer_activity = np.ones(12, dtype=bool)
         self.reality = 1
+        self.glyphs = cText.GlyphAtlas()
 
-    def setSceneGeometry(self):
-        self.scene.rotation = self.rotation
-        self.scene.layer_list = self.layer_activity
-        self.scene.scale = self.scale
+    def setSceneGeometry(self, scene=None):
+        if scene is None:
+            scene = self.scene
+        scene.rotation = np.asarray(self.rotation, dtype=np.float32)
+        scene.layer_list = self.layer_activity
+        scene.scale = self.scale
 
     def setInitSceneGeometry(self):
         self.reset_rotation = np.zeros((3, 3))
@@ -95,109 +104,365 @@ class ChochinCanvas(QGLWidget):
         self.reset_rotation[1, 2] = 1
         self.reset_rotation[2, 1] = 1
         self.rotation = self.reset_rotation[:]
-        if self.scene.getLargestDimension() > 0:
-            self.scale = 1./self.scene.getLargestDimension()
+        largest_dimension = self.scene.getLargestDimension()
+        if largest_dimension > 0:
+            self.scale = 1./largest_dimension
         else:
             self.scale = 1
         self.setSceneGeometry()
 
-    def setFile(self, filename):
+    def setFile(self, filename, threads=None, follow=False):
         print("[chochin] Set file")
-        self.data = cFile.chochinFile(filename.encode("utf8"))
-
-    def readFileAndDisplay(self):
-        self.data.setPalette(color_palette)
-        self.data.readChunk()
-        print("[chochin] File loaded")
-        self.scene = cScene.chochinScene(*self.data[self.frame])
+        self.follow = follow
+        self.load_all = threads is not None and not follow
+        if self.load_all:
+            self.data = cFile.openFile(filename.encode("utf8"), threads)
+        else:
+            self.data = cFile.openFile(filename.encode("utf8"),
+                                       follow=follow)
+            self.data.setCacheSize(self.cache_size)
+        self.frame_cache = cPlayback.FrameCache(self.cache_size)
+
+    def newScene(self, frame):
+        # bounds computed by the parser, if any
+        return cScene.chochinScene(*self.data[frame],
+                                   bounds=self.data.bounds(frame))
+
+    def displayFirstScene(self):
+        self.scene = self.newScene(self.frame)
         self.setInitSceneGeometry()
         self.loadScene()
 
-    def loadScene(self):
-        self.scene = cScene.chochinScene(*self.data[self.frame])
-        self.setSceneGeometry()
+    def prepareFrame(self, frame):
+        """Scene and VBO data of a frame.
+        Also called from the prefetch thread, so no GL calls here."""
+        scene = self.newScene(frame)
+        self.setSceneGeometry(scene)
 
-        pos, attrs = self.scene.getDisplayedScene()
-        # print(pos)
-        self.object_types = []
+        pos, attrs = scene.getDisplayedScene()
+        vbo_data = {}
+        layer_counts = {}
+        grids = {}
+
+        # objects grouped by layer and grid cell
+        for t in ["s", "l", "c"]:
+            if t in pos:
+                grids[t] = cGrid.ObjectGrid(pos[t], attrs[t].get("r"),
+                                            attrs[t]["y"], self.grid_size)
+                layer_counts[t] = cPrim.layer_counts(attrs[t]["y"])
 
         # sticks
         if "s" in pos:
-            self.objects["s"].set_data(pos["s"],
-                                       attrs["s"]["r"],
-                                       attrs["s"]["@"],
-                                       attrs["s"]["y"])
-            self.object_types.append("s")
+            o = grids["s"].order
+            vbo_data["s"] = cPrim.Sticks.vbo_data(pos["s"][o],
+                                                  attrs["s"]["r"][o],
+                                                  attrs["s"]["@"][o])
 
         # lines
         if "l" in pos:
-            self.objects["l"].set_data(pos["l"],
-                                       attrs["l"]["@"],
-                                       attrs["l"]["y"])
-            self.object_types.append("l")
+            o = grids["l"].order
+            vbo_data["l"] = cPrim.Lines.vbo_data(pos["l"][o],
+                                                 attrs["l"]["@"][o])
 
         # circles
         if "c" in pos:
-            self.objects["c"].set_data(pos["c"],
-                                       attrs["c"]["r"],
-                                       attrs["c"]["@"],
-                                       attrs["c"]["y"])
-            self.object_types.append("c")
+            o = grids["c"].order
+            vbo_data["c"] = cPrim.Circles.vbo_data(pos["c"][o],
+                                                   attrs["c"]["r"][o],
+                                                   attrs["c"]["@"][o])
 
-        # texts
+        # texts, by character
         if "t" in pos:
-            self.objects["t"] = (pos["t"], attrs["t"])
-            self.object_types.append("t")
+            vbo_data["t"], layer_counts["t"] =\
+                cText.Texts.vbo_data(pos["t"], attrs["t"]["s"],
+                                     attrs["t"]["@"], attrs["t"]["y"],
+                                     self.glyphs)
+
+        return cPlayback.PreparedFrame(scene, vbo_data, layer_counts, grids)
+
+    def loadScene(self):
+        prepared = self.frame_cache.get(self.frame)
+        if prepared is None:
+            prepared = self.prepareFrame(self.frame)
+            self.frame_cache.put(self.frame, prepared)
+        self.scene = prepared.scene
+        self.setSceneGeometry()
+        # the depth range follows the scale, fixed from the first frame,
+        # so that it is the same for all the frames
+        self.push_vector = [0, 0, 0.5/self.scale]
+
+        self.object_types = []
+        for t in ["s", "l", "c", "t"]:
+            if t in prepared.vbo_data:
+                self.objects[t].set_vbo(prepared.vbo_data[t],
+                                        prepared.layer_counts[t],
+                                        prepared.grids.get(t))
+                self.object_types.append(t)
+        # explicit colors met while parsing
+        self.colors.add_colors(self.data.color_table(self.colors.explicit_nb))
 
     def setXRotation(self, angleX):
         sinAngleX = np.sin(angleX)
         cosAngleX = np.cos(angleX)
-        generator = np.asmatrix([[1, 0, 0],
-                            [0, cosAngleX, -sinAngleX],
-                            [0, sinAngleX, cosAngleX]])
-        self.rotation = generator*self.rotation
+        generator = np.array([[1, 0, 0],
+                              [0, cosAngleX, -sinAngleX],
+                              [0, sinAngleX, cosAngleX]])
+        self.rotation = np.dot(generator, self.rotation)
 
     def setYRotation(self, angleY):
         sinAngleY = np.sin(angleY)
         cosAngleY = np.cos(angleY)
-        generator = np.asmatrix([[cosAngleY, -sinAngleY, 0],
-                            [sinAngleY, cosAngleY, 0],
-                            [0, 0, 1]])
-        self.rotation = generator*self.rotation
+        generator = np.array([[cosAngleY, -sinAngleY, 0],
+                              [sinAngleY, cosAngleY, 0],
+                              [0, 0, 1]])
+        self.rotation = np.dot(generator, self.rotation)
         
-    def start_anim(self):
-        self.parent().timer.start(self.speed, self.parent())
 
     def goToFrame(self, n, loop=False):
         self.former_frame = self.frame
         frame_nb = self.data.frame_nb()
-        if n > frame_nb - 2:
+        if n > frame_nb - 1:
             if loop:
                 self.frame = 0
             else:
-                self.frame = frame_nb - 2
+                self.frame = frame_nb - 1
         elif n < 0:
             if loop:
-                self.frame = frame_nb - 2
+                self.frame = frame_nb - 1
             else:
                 self.frame = 0
         else:
             self.frame = n
         self.loadScene()
 
+    def layerSwitch(self, label):
+        self.layer_activity[label] = not self.layer_activity[label]
+
+    def initializeGL(self):
+        """Initialize OpenGL, VBOs, upload data on the GPU, etc.
+        """
+        self.configureGL()
+        self.objects = {}
+        self.objects["s"] = cPrim.Sticks()
+        self.objects["c"] = cPrim.Circles()
+        self.objects["l"] = cPrim.Lines()
+        self.objects["t"] = cText.Texts()
+        self.colors = cPrim.ColorTable()
+        self.colors.set_palette(color_palette)
+
+        self.setPortSize(min(self.width, self.height))
+        self.offset = self.init_offset
+
+    def glpaint(self):
+        # def paintGL(self): # if no paintEvent
+
+        # clear the buffer
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+        if self.scene is None:
+            return
+
+        push_vector = self.push_vector
+        rotation = np.array(self.rotation, dtype=np.float32)
+        self.colors.bind(0)
+        for t in self.objects:
+            self.objects[t].set_uniform('u_colors', 0)
+        self.cullObjects(rotation)
+        for t in ["s", "l"]:
+            if t in self.object_types:
+                self.objects[t].set_uniform('u_scale', self.scale)
+                self.objects[t].set_uniform('u_rotation', rotation)
+                self.objects[t].set_uniform('u_push', push_vector)
+                self.objects[t].set_active_layers(self.layer_activity)
+                self.objects[t].draw()
+
+        if "c" in self.object_types:
+            self.objects["c"].set_uniform('u_scale', self.scale)
+            self.objects["c"].set_uniform('u_rad_scale', self.rad_scale)
+            self.objects["c"].set_uniform('u_linewidth', 1)
+            self.objects["c"].set_uniform('u_antialias', 1)
+            self.objects["c"].set_uniform('u_rotation', rotation)
+            self.objects["c"].set_uniform('u_push', push_vector)
+            self.objects["c"].set_active_layers(self.layer_activity)
+            self.objects["c"].set_uniform('u_reality',
+                                          self.reality)
+            self.objects["c"].draw()
+
+        # texts last, as they are blended over the objects behind
+        if "t" in self.object_types:
+            self.objects["t"].set_atlas(self.glyphs)
+            self.objects["t"].set_uniform('u_scale', self.scale)
+            self.objects["t"].set_uniform('u_rotation', rotation)
+            self.objects["t"].set_uniform('u_push', push_vector)
+            self.objects["t"].set_uniform('u_port_size', self.port_size)
+            self.objects["t"].set_active_layers(self.layer_activity)
+            self.objects["t"].draw()
+
+    def cullObjects(self, rotation):
+        """Only draw the groups of objects in view, and the tiny ones
+        coarsely."""
+        # visible part of the normalized device coordinates
+        pixels = 0.5*self.port_size
+        window = [-self.offset[0]/pixels - 1,
+                  (self.width - self.offset[0])/pixels - 1,
+                  -self.offset[1]/pixels - 1,
+                  (self.height - self.offset[1])/pixels - 1]
+        layer_table = cScene.chochinScene.layerTable(self.layer_activity)
+        for t in ["s", "l", "c"]:
+            grid = self.objects[t].grid
+            if t in self.object_types and grid is not None:
+                self.objects[t].set_visible_groups(
+                    *grid.visible(rotation, self.push_vector, self.scale,
+                                  window, pixels, layer_table,
+                                  self.lod_size))
+
+    def configureGL(self):
+        gl.glClearColor(*color_palette[1])
+        gl.glEnable(gl.GL_VERTEX_PROGRAM_POINT_SIZE)
+        gl.glEnable(gl.GL_DEPTH_TEST)
+        gl.glEnable(gl.GL_BLEND)
+        gl.glEnable(gl.GL_MULTISAMPLE)
+        gl.glEnable(gl.GL_POINT_SPRITE)
+        
+        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+
+    def enableGLPainting(self, qpainter=None):
+        if qpainter is not None:
+            qpainter.beginNativePainting()
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glPushMatrix()
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glPushMatrix()
+        self.configureGL()
+        self.setViewPort()
+        # set orthographic projection (2D only)
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glLoadIdentity()
+        # the window corner OpenGL coordinates are (-+1, -+1)
+        gl.glOrtho(-1, 1, 1, -1, -1, 1)
+
+    def disableGLPainting(self, qpainter=None):
+        gl.glDisable(gl.GL_VERTEX_PROGRAM_POINT_SIZE)
+        gl.glDisable(gl.GL_DEPTH_TEST)
+        gl.glDisable(gl.GL_BLEND)
+        # gl.glDisable(gl.GL_MULTISAMPLE)
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glPopMatrix()
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glPopMatrix()
+        if qpainter is not None:
+            qpainter.endNativePainting()
+
+    def setPortSize(self, size):
+        try:
+            inflate = size/self.port_size
+            self.offset[0] *= inflate
+            self.offset[1] *= inflate
+
+            self.offset[0] += self.width*(1-inflate)/2
+            self.offset[1] += self.height*(1-inflate)/2
+            self.offset[0] = int(self.offset[0])
+            self.offset[1] = int(self.offset[1])
+        except AttributeError:   # for init time
+            pass
+
+        self.port_size = int(size)
+        self.rad_scale = self.port_size
+
+    def setViewPort(self):
+        gl.glViewport(self.offset[0],
+                      self.offset[1],
+                      self.port_size,
+                      self.port_size)
+
+    def resizeGL(self, width, height):
+        """Called upon window resizing: reinitialize the viewport.
+        """
+        # update the window size
+        self.width, self.height = width, height
+
+        self.setViewPort()
+        # set orthographic projection (2D only)
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glLoadIdentity()
+        # the window corner OpenGL coordinates are (-+1, -+1)
+        gl.glOrtho(-1, 1, 1, -1, -1, 1)
+
+    def paintScene(self, painter=None):
+        """Paint with OpenGL, within native painting of painter if
+        any."""
+        self.enableGLPainting(painter)
+        self.glpaint()
+        self.disableGLPainting(painter)
+
+
+class ChochinCanvas(ChochinView, QGLWidget):
+    speed = 10
+    forward_anim = True
+    prefactor = ""
+    follow_period = 0.2     # sec, between checks of a followed file
+    prefetch_depth = 16     # frames prepared ahead during playback
+    prefetcher = None
+    frames_added = QtCore.pyqtSignal(int)
+
+    def __init__(self, parent=None):
+        QtOpenGL.QGLWidget.__init__(
+            self, QtOpenGL.QGLFormat(QtOpenGL.QGL.SampleBuffers), parent)
+        ChochinView.__init__(self)
+        self.installEventFilter(self)
+
+    def readFileAndDisplay(self):
+        if self.load_all:
+            self.data.readChunk()
+            print("[chochin] File loaded, "
+                  + str(self.data.frame_nb()) + " frames")
+        else:
+            self.data.buildIndex()
+            print("[chochin] File indexed, "
+                  + str(self.data.frame_nb()) + " frames")
+        if self.data.frame_nb() > 0:
+            self.displayFirstScene()
+        if self.follow:
+            self.frames_added.connect(self.addFrames)
+            follower = threading.Thread(target=self.followFile)
+            follower.daemon = True
+            follower.start()
+
+    def followFile(self):
+        """Index the frames appended to the file, out of the GUI thread.
+        The canvas is told about them through the frames_added signal,
+        with the number of frames before them."""
+        while not self.data.at_end():
+            former_frame_nb = self.data.frame_nb()
+            if self.data.update() > 0:
+                self.frames_added.emit(former_frame_nb)
+            else:
+                time.sleep(self.follow_period)
+
+    def addFrames(self, former_frame_nb):
+        # follow the last frame if it was displayed. More frames may
+        # have been added since, by updates whose signals are pending.
+        if self.scene is None:
+            self.displayFirstScene()
+        elif self.frame == former_frame_nb - 1:
+            self.goToFrame(self.data.frame_nb() - 1)
+        self.update()
+
+    def start_anim(self):
+        if self.prefetcher is None:
+            self.prefetcher = cPlayback.FramePrefetcher(self.prepareFrame,
+                                                        self.frame_cache,
+                                                        self.prefetch_depth)
+        self.parent().timer.start(self.speed, self.parent())
+
     def timerEvent(self, event):
         if event.timerId() == self.parent().timer.timerId():
-            if self.forward_anim:
-                self.goToFrame(self.frame + 1, loop=True)
-            else:
-                self.goToFrame(self.frame - 1, loop=True)
+            step = 1 if self.forward_anim else -1
+            self.goToFrame(self.frame + step, loop=True)
+            self.prefetcher.play(self.frame, step, self.data.frame_nb())
             self.update()
         else:
             QtGui.QWidget.timerEvent(self, event)
 
-    def layerSwitch(self, label):
-        self.layer_activity[label] = not self.layer_activity[label]
-
     def handleFrameSwitchKey(self, e, m):
         caught = False
         stop_anim = True
@@ -313,7 +578,7 @@ class ChochinCanvas(QGLWidget):
             caught = True
 
         if caught:
-            self.loadScene()
+            self.setSceneGeometry()
         return caught
 
     def handleRealityKey(self, e, m):
@@ -366,11 +631,11 @@ class ChochinCanvas(QGLWidget):
         elif e == QtCore.Qt.Key_F12:
             self.layerSwitch(11)
             caught = True
-        if caught:
-            self.loadScene()
         return caught
 
     def handleKey(self, e, m):
+        if self.scene is None:   # nothing read yet
+            return False
         caught = self.handleLayerKey(e, m)
         if not caught:
             caught = self.handlePointOfViewKey(e, m)
@@ -423,7 +688,7 @@ class ChochinCanvas(QGLWidget):
                 - (self.current_point.y() - self.previous_point.y())
             self.offset = [translateX, translateY]
             self.setViewPort()
-        elif self.rotate:
+        elif self.rotate and self.scene is not None:
             angleY = self.current_point.x() - self.previous_point.x()
             angleY *= -4/self.width
             self.setYRotation(angleY)
@@ -431,154 +696,9 @@ class ChochinCanvas(QGLWidget):
             angleX = self.current_point.y() - self.previous_point.y()
             angleX *= -4/self.height
             self.setXRotation(angleX)
-            self.loadScene()
+            self.setSceneGeometry()
 
         self.update()
 
-    def initializeGL(self):
-        """Initialize OpenGL, VBOs, upload data on the GPU, etc.
-        """
-        self.configureGL()
-        self.objects = {}
-        self.objects["s"] = cPrim.Sticks()
-        self.objects["c"] = cPrim.Circles()
-        self.objects["l"] = cPrim.Lines()
-
-        self.setPortSize(min(self.width, self.height))
-        self.offset = self.init_offset
-
-    def writeTexts(self, painter):
-        painter.setPen(QtCore.Qt.black)
-        if "t" in self.object_types:
-            pos, attrs = np.array(self.objects["t"][0]), self.objects["t"][1]
-            pos = pos[:, :2]
-
-            # go to gl "normalized device coordinates"
-            pos *= self.scale
-            # apply the transform from nd coords to viewport coords
-            pos += 1
-            pos *= 0.5*self.port_size
-            pos += self.offset
-            # now we need to account for the fact that in Qt y
-            # is from top to bottom
-            pos[:, 1] = self.height - pos[:, 1]
-
-            for i in range(len(pos)):
-                if self.layer_activity[attrs["y"][i]]:
-                    color_array = np.array(attrs["@"][i])*255
-                    color_array = color_array.astype(int)
-                    painter.setPen(QtGui.QColor(*color_array))
-                    painter.drawText(int(pos[i][0]),
-                                     int(pos[i][1]),
-                                     attrs["s"][i])
-
-    def glpaint(self):
-        # def paintGL(self): # if no paintEvent
-
-        # clear the buffer
-        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
-
-        push_vector = [0, 0, self.scene.getLargestDimension()/2.]
-        for t in ["s", "l"]:
-            if t in self.object_types:
-                self.objects[t].set_uniform('u_scale', self.scale)
-                self.objects[t].set_uniform('u_push', push_vector)
-                self.objects[t].set_uniform('u_active_layers',
-                                            self.layer_activity)
-                self.objects[t].draw()
-
-        if "c" in self.object_types:
-            self.objects["c"].set_uniform('u_scale', self.scale)
-            self.objects["c"].set_uniform('u_rad_scale', self.rad_scale)
-            self.objects["c"].set_uniform('u_linewidth', 1)
-            self.objects["c"].set_uniform('u_antialias', 1)
-            self.objects["c"].set_uniform('u_rotation',
-                                          np.array(self.rotation,
-                                                   dtype=np.float32))
-            self.objects["c"].set_uniform('u_push', push_vector)
-            self.objects["c"].set_uniform('u_active_layers',
-                                          self.layer_activity)
-            self.objects["c"].set_uniform('u_reality',
-                                          self.reality)
-            self.objects["c"].draw()
-
-    def configureGL(self):
-        gl.glClearColor(*color_palette[1])
-        gl.glEnable(gl.GL_VERTEX_PROGRAM_POINT_SIZE)
-        gl.glEnable(gl.GL_DEPTH_TEST)
-        gl.glEnable(gl.GL_BLEND)
-        gl.glEnable(gl.GL_MULTISAMPLE)
-        gl.glEnable(gl.GL_POINT_SPRITE)
-        
-        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
-
-    def enableGLPainting(self, qpainter):
-        qpainter.beginNativePainting()
-        gl.glMatrixMode(gl.GL_PROJECTION)
-        gl.glPushMatrix()
-        gl.glMatrixMode(gl.GL_MODELVIEW)
-        gl.glPushMatrix()
-        self.configureGL()
-        self.setViewPort()
-        # set orthographic projection (2D only)
-        gl.glMatrixMode(gl.GL_PROJECTION)
-        gl.glLoadIdentity()
-        # the window corner OpenGL coordinates are (-+1, -+1)
-        gl.glOrtho(-1, 1, 1, -1, -1, 1)
-
-    def disableGLPainting(self, qpainter):
-        gl.glDisable(gl.GL_VERTEX_PROGRAM_POINT_SIZE)
-        gl.glDisable(gl.GL_DEPTH_TEST)
-        gl.glDisable(gl.GL_BLEND)
-        # gl.glDisable(gl.GL_MULTISAMPLE)
-        gl.glMatrixMode(gl.GL_PROJECTION)
-        gl.glPopMatrix()
-        gl.glMatrixMode(gl.GL_MODELVIEW)
-        gl.glPopMatrix()
-        qpainter.endNativePainting()
-
     def paintEvent(self, event):
-        p = QtGui.QPainter(self)
-
-        self.enableGLPainting(p)
-        self.glpaint()
-        self.disableGLPainting(p)
-
-        # p.begin(self)
-        self.writeTexts(p)
-        # p.end()
-
-    def setPortSize(self, size):
-        try:
-            inflate = size/self.port_size
-            self.offset[0] *= inflate
-            self.offset[1] *= inflate
-
-            self.offset[0] += self.width*(1-inflate)/2
-            self.offset[1] += self.height*(1-inflate)/2
-            self.offset[0] = int(self.offset[0])
-            self.offset[1] = int(self.offset[1])
-        except AttributeError:   # for init time
-            pass
-
-        self.port_size = int(size)
-        self.rad_scale = self.port_size
-
-    def setViewPort(self):
-        gl.glViewport(self.offset[0],
-                      self.offset[1],
-                      self.port_size,
-                      self.port_size)
-
-    def resizeGL(self, width, height):
-        """Called upon window resizing: reinitialize the viewport.
-        """
-        # update the window size
-        self.width, self.height = width, height
-
-        self.setViewPort()
-        # set orthographic projection (2D only)
-        gl.glMatrixMode(gl.GL_PROJECTION)
-        gl.glLoadIdentity()
-        # the window corner OpenGL coordinates are (-+1, -+1)
-        gl.glOrtho(-1, 1, 1, -1, -1, 1)
+        self.paintScene(QtGui.QPainter(self))
@@ -2,92 +2,242 @@
 # distutils: sources = filereader.cpp
 
 from libcpp.vector cimport vector
-from libcpp.unordered_map cimport unordered_map as umap
 from libcpp.string cimport string
 from libcpp cimport bool
+from libcpp.memory cimport shared_ptr
+from libc.stdint cimport uint8_t, uint16_t, uint32_t
+from cpython.buffer cimport PyBUF_FORMAT, PyBUF_WRITABLE
 
 import numpy as np
 
+import chochinBinary
+import chochinScene
+
 from PyQt5 import QtCore, QtGui
 
 
 cdef extern from "filereader.cpp":
+  cdef struct Objects:
+    vector[float] positions
+    vector[uint16_t] colors
+    vector[uint8_t] layers
+    vector[float] radii
+
   cdef struct Frame:
-    umap[string, vector[float]] positions
-    umap[string, vector[float]] thicknesses
-    umap[string, vector[vector[float]]] colors
-    umap[string, vector[int]] layers
-    umap[string, vector[string]] texts
+    Objects circles
+    Objects sticks
+    Objects lines
+    Objects texts
+    vector[char] label_text
+    vector[uint32_t] label_offsets
+    float bounds[6]
 
 cdef extern from "filereader.cpp":
     cdef cppclass filereader:
-          filereader(string) except +
-          vector[Frame] frames
-          bool get()
-          void setPalette(vector[ vector [float] ])
+          filereader(string, bool) except +
+          void index() nogil except +
+          size_t update() nogil except +
+          bool atEnd() nogil
+          void load(size_t, size_t, unsigned) nogil except +
+          size_t frameNumber() nogil
+          shared_ptr[Frame] getFrame(size_t) nogil except +
+          vector[uint8_t] colorTable(size_t)
+          void setCacheSize(size_t)
+
+object_types = ("c", "s", "l", "t")
+object_dims = (3, 6, 6, 3)
+
+cdef Objects* frame_objects(Frame *frame, int k):
+    if k == 0:
+        return &frame.circles
+    elif k == 1:
+        return &frame.sticks
+    elif k == 2:
+        return &frame.lines
+    else:
+        return &frame.texts
+
+
+cdef class FrameBuffer:
+    """Read-only buffer over one of the arrays of a parsed frame.
+    NumPy arrays created from it share the frame memory, which is kept
+    alive as long as they exist."""
+    cdef shared_ptr[Frame] frame
+    cdef void *data
+    cdef const char *format
+    cdef Py_ssize_t itemsize
+    cdef Py_ssize_t shape[2]
+    cdef Py_ssize_t strides[2]
+
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        if flags & PyBUF_WRITABLE:
+            raise BufferError("frame buffers are read-only")
+        buffer.buf = self.data
+        buffer.format = <char*>self.format if flags & PyBUF_FORMAT else NULL
+        buffer.internal = NULL
+        buffer.itemsize = self.itemsize
+        buffer.len = self.shape[0]*self.shape[1]*self.itemsize
+        buffer.ndim = 2
+        buffer.obj = self
+        buffer.readonly = 1
+        buffer.shape = self.shape
+        buffer.strides = self.strides
+        buffer.suboffsets = NULL
+
+    def __releasebuffer__(self, Py_buffer *buffer):
+        pass
+
+cdef frame_array(shared_ptr[Frame] frame, void *data, size_t size,
+                 size_t cols, const char *format, Py_ssize_t itemsize):
+    cdef FrameBuffer b = FrameBuffer()
+    b.frame = frame
+    b.data = data
+    b.format = format
+    b.itemsize = itemsize
+    b.shape[0] = size//cols
+    b.shape[1] = cols
+    b.strides[0] = cols*itemsize
+    b.strides[1] = itemsize
+    return np.asarray(b)
+
+cdef float_array(shared_ptr[Frame] frame, vector[float] &v, size_t cols):
+    return frame_array(frame, v.data(), v.size(), cols, "f", sizeof(float))
+
+cdef uint8_array(shared_ptr[Frame] frame, vector[uint8_t] &v, size_t cols):
+    return frame_array(frame, v.data(), v.size(), cols, "B", sizeof(uint8_t))
+
+cdef uint16_array(shared_ptr[Frame] frame, vector[uint16_t] &v, size_t cols):
+    return frame_array(frame, v.data(), v.size(), cols, "H", sizeof(uint16_t))
+
+cdef uint32_array(shared_ptr[Frame] frame, vector[uint32_t] &v, size_t cols):
+    return frame_array(frame, v.data(), v.size(), cols, "I", sizeof(uint32_t))
+
+cdef label_text_array(shared_ptr[Frame] frame):
+    cdef vector[char] *text = &frame.get().label_text
+    if text.size() == 0:    # no buffer behind an empty vector
+        return np.zeros(0, dtype=np.uint8)
+    return frame_array(frame, text.data(), text.size(), 1, "B",
+                       sizeof(char))[:, 0]
 
 cdef class chochinFile:
     cdef filereader *thisptr      # hold a C++ instance which we're wrapping
-    cdef color_palette
-    def __cinit__(self, string fname):
-        self.thisptr = new filereader(fname)
+    cdef unsigned threads
+    def __cinit__(self, string fname, unsigned threads=1, bint follow=False):
+        """fname b"-" reads the standard input. With follow, frames
+        appended to the file (or arriving on a pipe) later on are
+        taken into account by update()."""
+        self.thisptr = new filereader(fname, follow)
+        self.threads = threads
 
     def __dealloc__(self):
         del self.thisptr
 
+    def buildIndex(self):
+        """Locate the frames in the file, without parsing them.
+        Frames are then parsed on demand by __getitem__.
+        The frame index is kept in an index file next to the data file,
+        so that it is built only the first time a file is opened."""
+        with nogil:
+            self.thisptr.index()
+
     def readChunk(self):
-        while self.thisptr.get():
-            pass
+        """Parse the whole file at once, with as many threads as
+        given at construction."""
+        with nogil:
+            self.thisptr.index()
+            self.thisptr.load(0, self.thisptr.frameNumber(), self.threads)
+
+    def update(self):
+        """In follow mode, index the frames appended to the file since
+        the last call, and return their number. On a pipe, this waits
+        for some data to arrive."""
+        cdef size_t n
+        with nogil:
+            n = self.thisptr.update()
+        return n
+
+    def at_end(self):
+        """True once a piped input has been read to its end."""
+        return self.thisptr.atEnd()
 
-    def setPalette(self, palette):
-        self.thisptr.setPalette(palette)
+    def color_table(self, first=0):
+        """Explicit colors of the file from the first-th one on, as
+        uint8 rgba. The color code of an object is a palette index
+        below 0x8000, 0x8000|k for the k-th explicit color, and a color
+        rounded to 8 levels per channel from 0xf000 on, once the table
+        is full. The table grows as frames are parsed."""
+        cdef vector[uint8_t] table = self.thisptr.colorTable(first)
+        if table.size() == 0:
+            return np.zeros((0, 4), dtype=np.uint8)
+        return np.frombuffer((<char*>table.data())[:table.size()],
+                             dtype=np.uint8).reshape((-1, 4))
+
+    def setCacheSize(self, size):
+        """Keep the parsed frames within about size bytes, dropping the
+        least recently used ones. By default all frames are kept."""
+        self.thisptr.setCacheSize(size)
+
+    cdef shared_ptr[Frame] frame(self, index) except *:
+        cdef size_t i = index
+        cdef shared_ptr[Frame] f
+        with nogil:
+            f = self.thisptr.getFrame(i)
+        return f
 
     def get_attrs(self, index):
-        frame_data = self.thisptr.frames[index]
-        frame_data_pos = dict(frame_data.positions)
+        cdef shared_ptr[Frame] frame = self.frame(index)
+        cdef Objects *objects
         attrs = {}
-        for o in frame_data_pos.keys():
-            o_str = o.decode()
-            if o == b"c" or o == b"s":
-                n = frame_data.layers[o].size()
-                attrs[o_str] = np.empty(n, [('y', int),
-                                            ('@', float, 4),
-                                            ('r', float)])
-                attrs[o_str]['y'] = frame_data.layers[o]
-                attrs[o_str]['@'] = frame_data.colors[o]
-                attrs[o_str]['r'] = frame_data.thicknesses[o]
-            elif o == b"l":
-                n = frame_data.layers[o].size()
-                attrs[o_str] = np.empty(n, [('y', np.uint8),
-                                        ('@', float, 4)])
-                attrs[o_str]['y'] = frame_data.layers[o]
-                attrs[o_str]['@'] = frame_data.colors[o]
-            elif o == b"t":
-                n = frame_data.layers[o].size()
-                attrs[o_str] = np.empty(n, [('y', np.uint8),
-                                        ('@', float, 4),
-                                        ('s', ('U', 100))])
-                attrs[o_str]['y'] = frame_data.layers[o]
-                attrs[o_str]['@'] = frame_data.colors[o]
-                attrs[o_str]['s'] = frame_data.texts[o]
+        for k, o in enumerate(object_types):
+            objects = frame_objects(frame.get(), k)
+            if objects.layers.size() == 0:
+                continue
+            attrs[o] = {'y': uint8_array(frame, objects.layers, 1)[:, 0],
+                        '@': uint16_array(frame, objects.colors, 1)[:, 0]}
+            if o == "c" or o == "s":
+                attrs[o]['r'] = float_array(frame, objects.radii, 1)[:, 0]
+            elif o == "t":
+                attrs[o]['s'] = chochinScene.Labels(
+                    label_text_array(frame),
+                    uint32_array(frame, frame.get().label_offsets, 1)[:, 0])
 
         return attrs
 
+    def bounds(self, index):
+        """Bounding box of the objects of a frame, as computed by the
+        parser: [[xmin, xmax], [ymin, ymax], [zmin, zmax]], or None
+        for a frame without objects."""
+        cdef shared_ptr[Frame] frame = self.frame(index)
+        cdef float *b = frame.get().bounds
+        if b[0] > b[3]:
+            return None
+        return np.array([[b[0], b[3]], [b[1], b[4]], [b[2], b[5]]])
+
     def __getitem__(self, index):
-        frame_data_pos = dict(self.thisptr.frames[index].positions)
+        """Positions and attributes of the objects of a frame, by object
+        type. The arrays are views on the parsed frame, without copies:
+        positions and radii are float32, layers uint8 and colors
+        uint16 color codes (see color_table), and text labels a
+        chochinScene.Labels over the UTF-8 text of the frame."""
+        cdef shared_ptr[Frame] frame = self.frame(index)
+        cdef Objects *objects
         pos = {}
-        size = {b'c': 3,
-                b's': 6,
-                b'l': 6,
-                b't': 3}
-        for o in frame_data_pos.keys():
-            o_str = o.decode()
-            pos[o_str] = np.array(frame_data_pos[o],
-                                  dtype=float)
-            pos[o_str].shape = (-1, size[o])
+        for k, o in enumerate(object_types):
+            objects = frame_objects(frame.get(), k)
+            if objects.layers.size() > 0:
+                pos[o] = float_array(frame, objects.positions, object_dims[k])
         attrs = self.get_attrs(index)
 
         return pos, attrs
 
     def frame_nb(self):
-        return self.thisptr.frames.size()
+        return self.thisptr.frameNumber()
+
+
+def openFile(fname, threads=1, follow=False):
+    """chochinFile of a Yaplot file, or chochinBinaryFile of a binary
+    Chochin file (as written by chochin-convert), which needs no
+    parsing. fname is given as bytes."""
+    if fname != b"-" and chochinBinary.isBinaryFile(fname):
+        return chochinBinary.chochinBinaryFile(fname)
+    return chochinFile(fname, threads, follow)
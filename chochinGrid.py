@@ -0,0 +1,102 @@
+#    Copyright 2016 Romain Mari
+#    This file is part of Chochin.
+#
+#    Chochin is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Uniform grid over the objects of a frame, so that only the objects in
+# view are drawn, and the tiny ones in a cheaper way.
+
+import numpy as np
+
+
+class ObjectGrid:
+    """Objects of one type binned in a uniform grid of side^3 cells.
+    Objects are grouped by layer, then by cell: once reordered by
+    order, the objects of a group are contiguous, and the groups follow
+    each other by layer. Each group keeps its bounding box and the
+    largest object size (radius or thickness), so that hidden groups
+    are skipped as a whole. Built without GL calls, as frames are
+    prepared by the prefetch thread."""
+
+    def __init__(self, positions, sizes, layers, side=16):
+        """positions: (n, 3) or (n, 6) (both ends of sticks and lines).
+        sizes: object sizes, or None for objects without size."""
+        n = len(positions)
+        points = np.reshape(positions, (n, -1, 3))
+        lower = points.min(axis=1)
+        upper = points.max(axis=1)
+        centers = 0.5*(lower + upper)
+
+        cell_nb = side**3
+        if n > 0:
+            low = centers.min(axis=0)
+            span = centers.max(axis=0) - low
+            span[span == 0] = 1
+            ijk = np.clip(((centers - low)*(side/span)).astype(np.int64),
+                          0, side-1)
+            cells = (ijk[:, 0]*side + ijk[:, 1])*side + ijk[:, 2]
+        else:
+            cells = np.zeros(0, dtype=np.int64)
+        keys = np.asarray(layers, dtype=np.int64)*cell_nb + cells
+        self.order = np.argsort(keys, kind="mergesort")
+        keys = keys[self.order]
+
+        first = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])[:n]
+        self.first = first
+        self.count = np.diff(np.r_[first, n])
+        self.layers = keys[first]//cell_nb
+        if n > 0:
+            self.lower = np.minimum.reduceat(lower[self.order], first)
+            self.upper = np.maximum.reduceat(upper[self.order], first)
+        else:
+            self.lower = self.upper = np.zeros((0, 3))
+        self.sized = sizes is not None
+        if self.sized and n > 0:
+            self.size = np.maximum.reduceat(np.asarray(sizes)[self.order],
+                                            first)
+        else:
+            self.size = np.zeros(len(first))
+        self.nbytes = sum(a.nbytes for a in [self.order, self.first,
+                                             self.count, self.layers,
+                                             self.lower, self.upper,
+                                             self.size])
+
+    def visible(self, rotation, push, scale, window, pixels, layer_table,
+                lod_size):
+        """Groups drawn in detail and drawn coarsely (when their objects
+        are below lod_size pixels), each as a pair of masks: the groups
+        in view, and the groups that may be drawn along with them (of
+        the active layers and the same detail, in view or not).
+        window: visible part of the normalized device coordinates, as
+        (xmin, xmax, ymin, ymax), and pixels: pixels per unit of them."""
+        centers = 0.5*(self.lower + self.upper)
+        radii = 0.5*np.sqrt(((self.upper - self.lower)**2).sum(axis=1))
+        radii += self.size
+        radii += 4./(scale*pixels)     # outlines and antialiasing
+        # as the vertex shaders do
+        ndc = (np.dot(centers, rotation) + push)*scale
+        radii *= scale
+        active = layer_table[self.layers]
+        in_view = active.copy()
+        in_view &= ndc[:, 0] + radii >= window[0]
+        in_view &= ndc[:, 0] - radii <= window[1]
+        in_view &= ndc[:, 1] + radii >= window[2]
+        in_view &= ndc[:, 1] - radii <= window[3]
+        if self.sized:
+            coarse = 2*self.size*scale*pixels < lod_size
+        else:
+            coarse = np.zeros_like(active)
+        return ((in_view & ~coarse, active & ~coarse),
+                (in_view & coarse, active & coarse))
@@ -0,0 +1,124 @@
+#    Copyright 2016 Romain Mari
+#    This file is part of Chochin.
+#
+#    Chochin is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+import collections
+
+
+class PreparedFrame:
+    """A frame ready to be displayed: its scene, and the VBO data of
+    its primitives, sorted by layer, with their number of objects in
+    each layer, and, for the primitives with a grid, by grid cell
+    within each layer."""
+
+    def __init__(self, scene, vbo_data, layer_counts, grids):
+        self.scene = scene
+        self.vbo_data = vbo_data
+        self.layer_counts = layer_counts
+        self.grids = grids
+
+        self.nbytes = sum(d.nbytes for d in vbo_data.values())
+        self.nbytes += sum(g.nbytes for g in grids.values())
+        for k in scene.obj_vals:
+            self.nbytes += scene.obj_vals[k].nbytes
+            self.nbytes += sum(getattr(a, "nbytes", 0)
+                               for a in scene.obj_attrs[k].values())
+
+
+class FrameCache:
+    """Prepared frames by frame number, within a memory budget (in
+    bytes). The least recently used frames are dropped first."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.frames = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, frame):
+        with self.lock:
+            try:
+                prepared = self.frames.pop(frame)
+            except KeyError:
+                return None
+            self.frames[frame] = prepared   # now the most recent
+            return prepared
+
+    def put(self, frame, prepared, keep=()):
+        """Add a prepared frame, dropping the least recently used frames
+        not in keep to make room for it. Return False if it does not
+        fit."""
+        with self.lock:
+            if frame in self.frames:
+                self.nbytes -= self.frames.pop(frame).nbytes
+            for f in list(self.frames):
+                if self.nbytes + prepared.nbytes <= self.budget:
+                    break
+                if f not in keep:
+                    self.nbytes -= self.frames.pop(f).nbytes
+            if self.nbytes + prepared.nbytes > self.budget:
+                return False
+            self.frames[frame] = prepared
+            self.nbytes += prepared.nbytes
+            return True
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.nbytes = 0
+
+
+class FramePrefetcher:
+    """Prepare the frames about to be played in a background thread,
+    so that the GUI thread only has to upload them.
+    prepare(frame) returns the PreparedFrame of a frame number."""
+
+    def __init__(self, prepare, cache, depth):
+        self.prepare = prepare
+        self.cache = cache
+        self.depth = depth
+        self.request = None
+        self.condition = threading.Condition()
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def play(self, frame, step, frame_nb):
+        """Prefetch the depth frames after frame, going by step and
+        looping over the frame_nb frames."""
+        with self.condition:
+            self.request = (frame, step, frame_nb)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.request is None:
+                    self.condition.wait()
+                frame, step, frame_nb = self.request
+                self.request = None
+
+            # not wrapping around onto the frame itself
+            ahead = [(frame + k*step) % frame_nb
+                     for k in range(1, min(self.depth, frame_nb - 1) + 1)]
+            for f in ahead:
+                if self.request is not None:   # playback moved on
+                    break
+                if self.cache.get(f) is None:
+                    if not self.cache.put(f, self.prepare(f), keep=ahead):
+                        break
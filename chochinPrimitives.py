@@ -1,5 +1,5 @@
+import ctypes
 import OpenGL.GL as gl
-import OpenGL.arrays.vbo as glvbo
 import numpy as np
 
 
@@ -76,6 +76,10 @@ def uniform_setter(utype, uname, usize):
     else:
         if utype == 'float':
             return lambda loc, val: gl.glUniform1f(loc, val)
+        if utype == 'sampler2D':     # texture unit
+            return lambda loc, val: gl.glUniform1i(loc, val)
+        if utype == 'vec2':
+            return lambda loc, val: gl.glUniform2fv(loc, 1, val)
         if utype[:3] == 'vec':
             return lambda loc, val: gl.glUniform3fv(loc, 1, val)
         if utype[:3] == 'mat':
@@ -84,7 +88,143 @@ def uniform_setter(utype, uname, usize):
     raise RuntimeError("cannot treat uniform ", utype, uname)
 
 
+def layer_counts(layers):
+    """Number of objects in each layer (0 to 255)."""
+    return np.bincount(layers, minlength=256)
+
+
+def runs(counts, shown, max_runs=None, mergeable=None):
+    """First object and number of objects of each run of consecutive
+    shown groups of objects, given the number of objects of each group.
+    With max_runs, the runs separated by the fewest hidden objects are
+    merged, keeping at most max_runs of them. With mergeable, runs are
+    only merged across groups of mergeable, and more runs are kept if
+    needed."""
+    ends = np.cumsum(counts)
+    # runs of shown groups: hidden groups (or no group) before and
+    # after them
+    run_starts = shown & ~np.r_[False, shown[:-1]]
+    run_ends = shown & ~np.r_[shown[1:], False]
+    first = (ends - counts)[run_starts]
+    last = ends[run_ends]
+    if max_runs is not None and len(first) > max_runs:
+        gaps = (first[1:] - last[:-1]).astype(np.float64)
+        if mergeable is not None:
+            # groups between the runs that must not be drawn
+            unmergeable = np.r_[0, np.cumsum(~mergeable)]
+            after_run = np.flatnonzero(run_ends)[:-1] + 1
+            before_run = np.flatnonzero(run_starts)[1:]
+            gaps[unmergeable[before_run] > unmergeable[after_run]] = np.inf
+        split_nb = max(max_runs - 1, np.count_nonzero(np.isinf(gaps)))
+        splits = np.argsort(gaps, kind="mergesort")
+        kept = np.sort(splits[len(gaps)-split_nb:])
+        first = np.r_[first[0], first[kept+1]]
+        last = np.r_[last[kept], last[-1]]
+    return first.astype(np.int32), (last - first).astype(np.int32)
+
+
+class StreamBuffer:
+    """Vertex buffer kept from frame to frame. Its storage only grows
+    when the data do not fit, otherwise the data are uploaded in
+    place. The storage is orphaned before each upload, so that the
+    driver does not wait for the draws still using the former data."""
+
+    def __init__(self):
+        self.buffer = gl.glGenBuffers(1)
+        self.capacity = 0   # bytes
+        self.vertex_nb = 0
+
+    def set_data(self, data):
+        data = np.ascontiguousarray(data)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffer)
+        if data.nbytes > self.capacity:
+            self.capacity = max(data.nbytes, 2*self.capacity)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, self.capacity, None,
+                        gl.GL_STREAM_DRAW)
+        if data.nbytes > 0:
+            gl.glBufferSubData(gl.GL_ARRAY_BUFFER, 0, data.nbytes, data)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+        self.vertex_nb = len(data)
+
+    def bind(self):
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffer)
+
+    def unbind(self):
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+
+class ColorTable:
+    """Colors of the objects, by color code: palette indices below
+    0x8000 (wrapping around the palette), explicit colors of the file
+    from 0x8000 on, and a cube of 8 levels of r, g, b and a from
+    0xf000 on. The shaders look the codes up in a 256x256 texture."""
+    explicit_color = 0x8000
+    color_cube = 0xf000
+
+    def __init__(self):
+        self.rgba = np.zeros((256*256, 4), dtype=np.uint8)
+        levels = np.rint(np.arange(8)*255/7.).astype(np.uint8)
+        cube = np.indices((8, 8, 8, 8)).reshape((4, -1)).T
+        self.rgba[self.color_cube:] = levels[cube]
+        self.explicit_nb = 0
+        self.texture = None
+        self.changed = True
+
+    def set_palette(self, palette):
+        """palette as rgba floats in [0, 1]."""
+        palette = np.rint(255*np.clip(palette, 0, 1)).astype(np.uint8)
+        self.rgba[:self.explicit_color] =\
+            palette[np.arange(self.explicit_color) % len(palette)]
+        self.changed = True
+
+    def add_colors(self, colors):
+        """Append explicit colors (uint8 rgba) to the table."""
+        if len(colors) == 0:
+            return
+        first = self.explicit_color + self.explicit_nb
+        self.rgba[first:first+len(colors)] = colors
+        self.explicit_nb += len(colors)
+        self.changed = True
+
+    def lookup(self, codes):
+        """uint8 rgba colors of color codes."""
+        return self.rgba[codes]
+
+    def bind(self, unit=0):
+        """Bind the texture to a texture unit, uploading the table if
+        it changed."""
+        gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+        if self.texture is None:
+            self.texture = gl.glGenTextures(1)
+            gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture)
+            for p in [gl.GL_TEXTURE_MIN_FILTER, gl.GL_TEXTURE_MAG_FILTER]:
+                gl.glTexParameteri(gl.GL_TEXTURE_2D, p, gl.GL_NEAREST)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture)
+        if self.changed:
+            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
+            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA8, 256, 256, 0,
+                            gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, self.rgba)
+            self.changed = False
+
+
+# color of a color code, for the vertex shaders (see ColorTable)
+color_lookup = """
+    uniform sampler2D u_colors;
+
+    vec4 lookupColor(float code) {
+        vec2 texel = vec2(mod(code, 256.0), floor(code/256.0));
+        return texture2D(u_colors, (texel + 0.5)/256.0);
+    }
+"""
+
+
 class ChochinPrimitiveArray:
+    # the objects are drawn by ranges of layers, in vertices
+    # (or instances) per object
+    vertices_per_object = 1
+    # draw calls at most, when drawing the groups of a grid
+    max_runs = 64
+
     def __init__(self, vertex_code, fragment_code, gl_primitive):
         self.shaders_program = make_shader_program(vertex_code,
                                                    fragment_code)
@@ -97,6 +237,16 @@ class ChochinPrimitiveArray:
         self.uniforms_val = {}
         self.parse_shader_var(vertex_code, fragment_code)
         self.gl_primitive = gl_primitive
+        self.vbo = StreamBuffer()
+        # for instanced primitives, the vbo holds one record per instance
+        # with instance_attributes, and shape the vertices shared by all
+        # instances, with attributes
+        self.instance_attributes = None
+        self.shape = None
+        self.layer_counts = None
+        self.active_layers = None
+        self.grid = None
+        self.visible_groups = None
 
     def parse_shader_var(self, vertex_code, fragment_code):
         in_var = parse_shader(vertex_code + fragment_code)
@@ -106,7 +256,6 @@ class ChochinPrimitiveArray:
                 gl.glGetAttribLocation(self.shaders_program, a_name)
             self.attributes_size[a_name],\
                 self.attributes_type[a_name] = attribute_size(a_type)
-        self.attribute_stride = 4*sum(self.attributes_size.values())
 
         for u in in_var['uniform']:
             u_type, u_name, u_size = u
@@ -115,57 +264,148 @@ class ChochinPrimitiveArray:
             self.uniforms_setters[u_name] =\
                 uniform_setter(u_type, u_name, u_size)
 
-    def set_vbo(self, data):
-        self.vbo = glvbo.VBO(data, usage='GL_STATIC_DRAW_ARB')
+    def set_vbo(self, data, layer_counts=None, grid=None):
+        """With layer_counts (the number of objects in each layer), the
+        objects of data are expected sorted by layer, and only the
+        active layers are drawn. With grid (a chochinGrid.ObjectGrid),
+        they are expected in the order of its groups, and only the
+        groups set by set_visible_groups are drawn."""
+        self.vbo.set_data(data)
+        self.layer_counts = layer_counts
+        self.grid = grid
+        self.visible_groups = None
+
+    def set_visible_groups(self, detailed, coarse):
+        """Groups of the grid to draw in detail, and in the cheaper way
+        of the primitive (see set_coarse), each as a pair of masks: the
+        groups to draw, and the groups that may be drawn along with
+        them to save draw calls."""
+        self.visible_groups = (detailed, coarse)
+
+    def set_coarse(self, coarse):
+        """Switch to a cheaper way of drawing the objects, for tiny
+        ones. Nothing cheaper by default."""
+        pass
+
+    def set_active_layers(self, active_layers):
+        """Layers to draw, as a mask over the first layers. Layers
+        beyond the mask are always drawn."""
+        self.active_layers = active_layers
+
+    def layer_ranges(self):
+        """First object and number of objects of each run of
+        consecutive layers to draw."""
+        if self.layer_counts is None or self.active_layers is None:
+            return (np.zeros(1, dtype=np.int32),
+                    np.array([self.vbo.vertex_nb//self.vertices_per_object],
+                             dtype=np.int32))
+        present = np.nonzero(self.layer_counts)[0]
+        shown = np.ones(len(self.layer_counts), dtype=bool)
+        shown[:len(self.active_layers)] = self.active_layers
+        return runs(self.layer_counts[present], shown[present])
 
     def set_uniform(self, name, value):
         if name not in self.uniforms_loc:
             raise RuntimeError("unknown uniform")
         self.uniforms_val[name] = value
 
-    def draw(self):
-        self.vbo.bind()
-        for a in self.attributes_loc:
+    def set_attribute_pointers(self, buffer, attributes, first=0):
+        """Point the attributes to buffer, where they are interleaved,
+        starting from record first."""
+        buffer.bind()
+        stride = 4*sum(self.attributes_size[a] for a in attributes)
+        offset = first*stride
+        for a in attributes:
             gl.glEnableVertexAttribArray(self.attributes_loc[a])
-        offset = 0
-        for a in self.attributes:
             gl.glVertexAttribPointer(self.attributes_loc[a],
                                      self.attributes_size[a],
                                      self.attributes_type[a],
                                      gl.GL_FALSE,
-                                     self.attribute_stride,
-                                     self.vbo + offset)
+                                     stride,
+                                     ctypes.c_void_p(offset))
             offset += 4*self.attributes_size[a]
+        buffer.unbind()
+
+    def draw(self):
+        if self.grid is None or self.visible_groups is None:
+            self.draw_ranges(*self.layer_ranges())
+            return
+        detailed, coarse = self.visible_groups
+        self.draw_ranges(*runs(self.grid.count, detailed[0], self.max_runs,
+                               detailed[1]))
+        if coarse[0].any():
+            self.set_coarse(True)
+            self.draw_ranges(*runs(self.grid.count, coarse[0], self.max_runs,
+                                   coarse[1]))
+            self.set_coarse(False)
+
+    def draw_ranges(self, first, count):
+        """Draw the objects from first[i] on, count[i] of them."""
+        if len(first) == 0:
+            return
+
+        if self.instance_attributes is None:
+            self.set_attribute_pointers(self.vbo, self.attributes)
+        else:
+            self.set_attribute_pointers(self.shape, self.attributes)
+            for a in self.instance_attributes:
+                gl.glVertexAttribDivisor(self.attributes_loc[a], 1)
 
         gl.glUseProgram(self.shaders_program)
         for u in self.uniforms_loc:
             self.uniforms_setters[u](self.uniforms_loc[u],
                                      self.uniforms_val[u])
 
-        gl.glDrawArrays(self.gl_primitive, 0, len(self.vbo.data))
-        self.vbo.unbind()
+        if self.instance_attributes is None:
+            gl.glMultiDrawArrays(self.gl_primitive,
+                                 self.vertices_per_object*first,
+                                 self.vertices_per_object*count,
+                                 len(first))
+        else:
+            for f, c in zip(first, count):
+                self.set_attribute_pointers(self.vbo,
+                                            self.instance_attributes, int(f))
+                gl.glDrawArraysInstanced(self.gl_primitive, 0,
+                                         self.shape.vertex_nb, int(c))
+            # the divisors would apply to the other primitives too
+            for a in self.instance_attributes:
+                gl.glVertexAttribDivisor(self.attributes_loc[a], 0)
 
 
 class Sticks(ChochinPrimitiveArray):
     s_vert = """
     #version 120
-
+""" + color_lookup + """
     // Uniforms
     uniform float u_scale;
+    uniform mat3 u_rotation;
     uniform vec3 u_push;
-    uniform float u_active_layers[12];
 
-    attribute vec3 a_position;
-    attribute vec4 a_fg_color;
-    attribute float a_layer;
+    // Attributes
+    // a_corner: which end (0 or 1), which side (-1 or 1), from the
+    // shared quad; the others are per stick
+    attribute vec2 a_corner;
+    attribute vec3 a_start;
+    attribute vec3 a_end;
+    attribute float a_thickness;
+    attribute float a_color;
 
     varying vec4 v_fg_color;
-    varying float v_discard;
 
     void main (void) {
-        v_discard = u_active_layers[int(a_layer)];
-        v_fg_color  = a_fg_color;
-        gl_Position = vec4((a_position+u_push)*u_scale,1.0);
+        v_fg_color  = lookupColor(a_color);
+        vec3 start = u_rotation*a_start;
+        vec3 end = u_rotation*a_end;
+        // the stick is widened perpendicularly to its projection on
+        // the screen, so that it always faces the viewer
+        vec2 direction = end.xy - start.xy;
+        vec3 normal = vec3(0.0);
+        if (length(direction) > 0.0) {
+            normal.xy = a_thickness*normalize(vec2(direction.y,
+                                                   -direction.x));
+        }
+        vec3 position = mix(start, end, a_corner.x) + a_corner.y*normal;
+        gl_Position = vec4((position+u_push)*u_scale,1.0);
     }
     """
 
@@ -173,13 +413,9 @@ class Sticks(ChochinPrimitiveArray):
     #version 120
 
     varying vec4 v_fg_color;
-    varying float v_discard;
 
     void main()
     {
-        if (v_discard < 0.1) {
-            discard;
-        }
         gl_FragColor = v_fg_color;
     }
     """
@@ -189,36 +425,44 @@ class Sticks(ChochinPrimitiveArray):
                                        self.s_vert,
                                        self.s_frag,
                                        gl.GL_TRIANGLES)
-
-    def set_data(self, line_ends, thicknesses, colors, layers):
+        # sticks are instances of a quad
+        self.attributes = ['a_corner']
+        self.instance_attributes = ['a_start', 'a_end', 'a_thickness',
+                                    'a_color']
+        self.quad = StreamBuffer()
+        self.quad.set_data(self.corners)
+        # thin sticks as lines, from one end to the other
+        self.line = StreamBuffer()
+        self.line.set_data(self.ends)
+        self.shape = self.quad
+
+    # corners of the 2 triangles making a stick, as (end, side)
+    corners = np.array([[0, 1], [0, -1], [1, 1],
+                        [0, -1], [1, 1], [1, -1]], dtype=np.float32)
+    ends = np.array([[0, 0], [1, 0]], dtype=np.float32)
+
+    def set_coarse(self, coarse):
+        self.shape = self.line if coarse else self.quad
+        self.gl_primitive = gl.GL_LINES if coarse else gl.GL_TRIANGLES
+
+    @staticmethod
+    def vbo_data(line_ends, thicknesses, colors):
         n = line_ends.shape[0]
-        normals = np.empty(shape=(n, 3))
-        normals[:, 0] = np.ravel(line_ends[:, 4] - line_ends[:, 1])
-        normals[:, 1] = np.ravel(line_ends[:, 0] - line_ends[:, 3])
-        normals[:, 2] = 0
-        normals /= np.linalg.norm(normals, axis=1)[:, np.newaxis]
-        a_position = np.empty(shape=(6*n, 3))
-        thicknesses = thicknesses.reshape((n, 1))
-        a_position[::6] = line_ends[:, :3]+thicknesses*normals
-        a_position[1::6] = line_ends[:, :3]-thicknesses*normals
-        a_position[2::6] = line_ends[:, 3:]+thicknesses*normals
-        a_position[3::6] = a_position[1::6]
-        a_position[4::6] = a_position[2::6]
-        a_position[5::6] = line_ends[:, 3:]-thicknesses*normals
-        colors = np.repeat(colors, 6, axis=0)
-        layers = np.repeat(layers, 6, axis=0)
-        vbo_data = np.column_stack((a_position,
-                                    colors,
-                                    layers)).astype(np.float32)
-        self.set_vbo(vbo_data)
-        self.attributes = ['a_position', 'a_fg_color', 'a_layer']
+        # one record per stick, interleaved as both ends, thickness,
+        # color code. The vertex shader places the corners of the quad
+        # once rotated.
+        vbo_data = np.empty(shape=(n, 8), dtype=np.float32)
+        vbo_data[:, :6] = line_ends
+        vbo_data[:, 6] = thicknesses
+        vbo_data[:, 7] = colors
+        return vbo_data
 
 
 class Circles(ChochinPrimitiveArray):
     # shaders credit VisPy https://github.com/vispy/vispy (cloud.py example)
     c_vert = """
     #version 120
-
+""" + color_lookup + """
     // Uniforms
     // ------------------------------------
     uniform float u_linewidth;
@@ -228,14 +472,13 @@ class Circles(ChochinPrimitiveArray):
     uniform mat3 u_rotation;
     uniform vec3 u_push;
     uniform float u_reality;
-    uniform float u_active_layers[12];
+    uniform float u_flat;       // tiny circles, as plain points
 
     // Attributes
     // ------------------------------------
     attribute vec3  a_position;
-    attribute vec4  a_color;
+    attribute float a_color;
     attribute float a_size;
-    attribute float a_layer;
 
     // Varyings
     // ------------------------------------
@@ -244,29 +487,32 @@ class Circles(ChochinPrimitiveArray):
     varying float v_size;
     varying float v_linewidth;
     varying float v_antialias;
-    varying float v_discard;
 
     void main (void) {
         v_size = a_size*u_rad_scale*u_scale;
         v_linewidth = u_linewidth;
         v_antialias = u_antialias;
+        v_bg_color  = lookupColor(a_color);
         if (u_reality == 1.) {
             v_fg_color  = vec4(0, 0, 0, 1);
         } else {
-            v_fg_color  = a_color;
+            v_fg_color  = v_bg_color;
         }
-        v_bg_color  = a_color;
-        v_discard = u_active_layers[int(a_layer)];
         gl_Position = vec4((u_rotation*a_position+u_push)*u_scale,1.0);
-        gl_PointSize = v_size + 2*(v_linewidth + 1.5*v_antialias);
+        if (u_flat == 1.) {
+            gl_PointSize = max(v_size, 1.0);
+        } else {
+            gl_PointSize = v_size + 2*(v_linewidth + 1.5*v_antialias);
+        }
     }
     """
 
     c_frag = """
     #version 120
 
-    // Constants
+    // Uniforms
     // ------------------------------------
+    uniform float u_flat;
 
 
     // Varyings
@@ -276,7 +522,6 @@ class Circles(ChochinPrimitiveArray):
     varying float v_size;
     varying float v_linewidth;
     varying float v_antialias;
-    varying float v_discard;
 
     // Functions
     // ------------------------------------
@@ -293,8 +538,9 @@ class Circles(ChochinPrimitiveArray):
     // ------------------------------------
     void main()
     {
-        if (v_discard < 0.1) {
-            discard;
+        if (u_flat == 1.) {
+            gl_FragColor = v_bg_color;
+            return;
         }
         float size = v_size +2*(v_linewidth + 1.5*v_antialias);
         float t = v_linewidth/2.0-v_antialias;
@@ -327,42 +573,44 @@ class Circles(ChochinPrimitiveArray):
                                        self.c_vert,
                                        self.c_frag,
                                        gl.GL_POINTS)
+        self.attributes = ['a_position',
+                           'a_color',
+                           'a_size']
+        self.set_uniform('u_flat', 0)
 
-    def set_data(self, centers, radii, colors, layers):
+    def set_coarse(self, coarse):
+        self.set_uniform('u_flat', 1 if coarse else 0)
+
+    @staticmethod
+    def vbo_data(centers, radii, colors):
         n = centers.shape[0]
-        data_c = np.zeros((n, 9), dtype=np.float32)
+        data_c = np.empty((n, 5), dtype=np.float32)
         data_c[:, :3] = centers
-        data_c[:, 3:7] = colors
-        data_c[:, 7] = radii
-        data_c[:, 8] = layers
-        self.set_vbo(data_c)
-        self.attributes = ['a_position',
-                           'a_color',
-                           'a_size',
-                           'a_layer']
+        data_c[:, 3] = colors
+        data_c[:, 4] = radii
+        return data_c
 
 
 class Lines(ChochinPrimitiveArray):
+    vertices_per_object = 2
+
     vert = """
     #version 120
-
+""" + color_lookup + """
     // Uniforms
     uniform float u_scale;
+    uniform mat3 u_rotation;
     uniform vec3 u_push;
-    uniform float u_active_layers[12];
 
     // Attributes
     attribute vec3  a_position;
-    attribute vec4  a_fg_color;
-    attribute float a_layer;
+    attribute float a_color;
 
     varying vec4 v_fg_color;
-    varying float v_discard;
 
     void main (void) {
-        v_discard = u_active_layers[int(a_layer)];
-        v_fg_color  = a_fg_color;
-        gl_Position = vec4((a_position+u_push)*u_scale,1.0);
+        v_fg_color  = lookupColor(a_color);
+        gl_Position = vec4((u_rotation*a_position+u_push)*u_scale,1.0);
     }
     """
 
@@ -370,13 +618,9 @@ class Lines(ChochinPrimitiveArray):
     #version 120
 
     varying vec4 v_fg_color;
-    varying float v_discard;
 
     void main()
     {
-        if (v_discard < 0.1) {
-            discard;
-        }
        gl_FragColor = v_fg_color;
     }
     """
@@ -386,13 +630,13 @@ class Lines(ChochinPrimitiveArray):
                                        self.vert,
                                        self.frag,
                                        gl.GL_LINES)
+        self.attributes = ['a_position', 'a_color']
 
-    def set_data(self, line_ends, colors, layers):
-        line_ends = line_ends.reshape((-1, 3))
-        colors = np.repeat(colors, 2, axis=0)
-        layers = np.repeat(layers, 2, axis=0)
-        vbo_data = np.column_stack((line_ends,
-                                    colors,
-                                    layers)).astype(np.float32)
-        self.set_vbo(vbo_data)
-        self.attributes = ['a_position', 'a_fg_color', 'a_layer']
+    @staticmethod
+    def vbo_data(line_ends, colors):
+        n = line_ends.shape[0]
+        # 2 vertices per line, interleaved as position, color code
+        vbo_data = np.empty(shape=(n, 2, 4), dtype=np.float32)
+        vbo_data[:, :, :3] = line_ends.reshape((n, 2, 3))
+        vbo_data[:, :, 3] = colors[:, np.newaxis]
+        return vbo_data.reshape((-1, 4))
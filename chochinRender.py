@@ -0,0 +1,310 @@
+#    Copyright 2016 Romain Mari
+#    This file is part of Chochin.
+#
+#    Chochin is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import ctypes
+import subprocess
+import multiprocessing
+
+# frames are rendered in an OpenGL context made with EGL, which needs
+# no display. PyOpenGL has to be told before OpenGL is first imported.
+if "PYOPENGL_PLATFORM" not in os.environ:
+    os.environ["PYOPENGL_PLATFORM"] = "egl"
+if "QT_QPA_PLATFORM" not in os.environ:
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+
+import numpy as np
+import OpenGL.GL as gl
+from OpenGL import EGL
+from OpenGL.error import NullFunctionError
+from OpenGL.EGL.EXT.platform_base import eglGetPlatformDisplayEXT
+from OpenGL.EGL.EXT.device_enumeration import eglQueryDevicesEXT
+from OpenGL.EGL.EXT.platform_device import EGL_PLATFORM_DEVICE_EXT
+
+from PyQt5 import QtGui
+
+import chochinCanvas as cCanvas
+import chochinFile as cFile
+
+EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+
+
+def eglDisplays():
+    """EGL displays needing no window system: of the devices (GPUs, or
+    Mesa's software renderer), then of Mesa's surfaceless platform."""
+    displays = []
+    try:
+        devices = (EGL.EGLDeviceEXT*16)()
+        device_nb = EGL.EGLint()
+        if eglQueryDevicesEXT(16, devices, ctypes.pointer(device_nb)):
+            displays += [(EGL_PLATFORM_DEVICE_EXT, devices[i])
+                         for i in range(device_nb.value)]
+    except (EGL.EGLError, NullFunctionError):
+        pass
+    displays.append((EGL_PLATFORM_SURFACELESS_MESA, None))
+    for platform, device in displays:
+        try:
+            display = eglGetPlatformDisplayEXT(platform, device, None)
+            if display and EGL.eglInitialize(display, None, None):
+                yield display
+        except (EGL.EGLError, NullFunctionError):
+            pass
+
+
+def eglContext():
+    """Make current an OpenGL context, drawing to a pbuffer which is
+    not used (frames are drawn to framebuffer objects). Return the
+    display, the surface and the context."""
+    config_attributes = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                         EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                         EGL.EGL_NONE]
+    pbuffer_attributes = [EGL.EGL_WIDTH, 1, EGL.EGL_HEIGHT, 1, EGL.EGL_NONE]
+    for display in eglDisplays():
+        try:
+            config = EGL.EGLConfig()
+            config_nb = EGL.EGLint()
+            if not EGL.eglChooseConfig(
+                    display,
+                    (EGL.EGLint*len(config_attributes))(*config_attributes),
+                    ctypes.pointer(config), 1, ctypes.pointer(config_nb))\
+               or config_nb.value == 0\
+               or not EGL.eglBindAPI(EGL.EGL_OPENGL_API):
+                continue
+            surface = EGL.eglCreatePbufferSurface(
+                display, config,
+                (EGL.EGLint*len(pbuffer_attributes))(*pbuffer_attributes))
+            context = EGL.eglCreateContext(display, config,
+                                           EGL.EGL_NO_CONTEXT, None)
+            if surface and context\
+               and EGL.eglMakeCurrent(display, surface, surface, context):
+                return display, surface, context
+        except EGL.EGLError:
+            pass
+    raise RuntimeError("Could not create an OpenGL context with EGL.")
+
+
+class OffscreenRenderer(cCanvas.ChochinView):
+    """Render frames to images in an OpenGL context made with EGL,
+    without any window nor display. Needs a QGuiApplication (for the
+    fonts of the labels), which can run on the "offscreen" Qt
+    platform."""
+
+    samples = 4     # multisampling
+
+    def __init__(self, width, height):
+        cCanvas.ChochinView.__init__(self)
+        self.width, self.height = width, height
+        self.egl = eglContext()
+
+        # multisampled framebuffer, resolved into a plain one to be read
+        self.fbo = self.framebuffer(width, height, self.samples, True)
+        self.resolved_fbo = self.framebuffer(width, height, 0, False)
+
+        self.initializeGL()
+        # center the view
+        self.offset = [(width - self.port_size)//2,
+                       (height - self.port_size)//2]
+        self.resizeGL(width, height)
+
+    @staticmethod
+    def framebuffer(width, height, samples, depth):
+        fbo = gl.glGenFramebuffers(1)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, fbo)
+        attachments = [(gl.GL_RGBA8, gl.GL_COLOR_ATTACHMENT0)]
+        if depth:
+            attachments.append((gl.GL_DEPTH24_STENCIL8,
+                                gl.GL_DEPTH_STENCIL_ATTACHMENT))
+        for storage, attachment in attachments:
+            buffer = gl.glGenRenderbuffers(1)
+            gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, buffer)
+            gl.glRenderbufferStorageMultisample(gl.GL_RENDERBUFFER, samples,
+                                                storage, width, height)
+            gl.glFramebufferRenderbuffer(gl.GL_FRAMEBUFFER, attachment,
+                                         gl.GL_RENDERBUFFER, buffer)
+        status = gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+        if status != gl.GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError("Could not create a framebuffer.")
+        return fbo
+
+    def readFile(self):
+        if self.load_all:
+            self.data.readChunk()
+        else:
+            self.data.buildIndex()
+        if self.data.frame_nb() == 0:
+            raise RuntimeError("No frame to render.")
+        self.displayFirstScene()
+
+    def render(self, frame):
+        """Image of a frame, as a QImage."""
+        self.goToFrame(frame)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.fbo)
+        self.paintScene()
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.fbo)
+        gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, self.resolved_fbo)
+        gl.glBlitFramebuffer(0, 0, self.width, self.height,
+                             0, 0, self.width, self.height,
+                             gl.GL_COLOR_BUFFER_BIT, gl.GL_NEAREST)
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.resolved_fbo)
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 4)
+        pixels = gl.glReadPixels(0, 0, self.width, self.height,
+                                 gl.GL_RGBA, gl.GL_UNSIGNED_BYTE)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+        # OpenGL rows go upwards
+        rows = np.frombuffer(pixels, dtype=np.uint8)
+        rows = rows.reshape((self.height, 4*self.width))[::-1].tobytes()
+        image = QtGui.QImage(rows, self.width, self.height, 4*self.width,
+                             QtGui.QImage.Format_RGBA8888_Premultiplied)
+        return image.copy()
+
+
+def frameRange(frames, frame_nb):
+    """Frame numbers (from 0) given as first:last:step, which are read
+    as a Python slice over the frame_nb frames."""
+    bounds = [int(b) if b else None for b in frames.split(":")]
+    if len(bounds) > 3:
+        raise ValueError("Frames should be given as first:last:step.")
+    return range(*slice(*bounds).indices(frame_nb))
+
+
+def rawRGB(image):
+    """Pixels of image as rgb24 bytes, row after row."""
+    image = image.convertToFormat(QtGui.QImage.Format_RGB888)
+    bits = image.constBits()
+    bits.setsize(image.byteCount())
+    rows = np.frombuffer(bits, dtype=np.uint8)
+    rows = rows.reshape((image.height(), image.bytesPerLine()))
+    return rows[:, :3*image.width()].tobytes()
+
+
+def saveImage(image, pattern, frame):
+    if not image.save(pattern % frame):
+        raise RuntimeError("Could not write "+pattern % frame)
+
+
+def reportSpeed(frame_nb, elapsed):
+    if frame_nb == 0 or elapsed <= 0:
+        sys.stderr.write("[chochin] {} frames rendered\n".format(frame_nb))
+        return
+    speed = frame_nb/elapsed
+    sys.stderr.write("[chochin] {} frames rendered in {:.2f} s "
+                     "({:.1f} frames/s)\n".format(frame_nb, elapsed, speed))
+
+
+def renderFrames(renderer, frames, pattern=None, pipe=None):
+    """Render frames, saving them as images to pattern % frame and/or
+    writing them as raw rgb24 data to the standard input of the shell
+    command pipe (typically a video encoder).
+    The throughput is reported on the standard error."""
+    if pipe is not None:
+        encoder = subprocess.Popen(pipe, shell=True, stdin=subprocess.PIPE)
+
+    start = time.time()
+    for frame in frames:
+        image = renderer.render(frame)
+        if pattern is not None:
+            saveImage(image, pattern, frame)
+        if pipe is not None:
+            encoder.stdin.write(rawRGB(image))
+    elapsed = time.time() - start
+
+    if pipe is not None:
+        encoder.stdin.close()
+        encoder.wait()
+    reportSpeed(len(frames), elapsed)
+
+
+# renderer of a worker process, with its own offscreen context and
+# frame index
+worker = None
+
+
+def initWorker(filename, width, height):
+    global worker
+    # a pool starts new workers as long as this fails, so the error is
+    # kept and raised from renderChunk instead
+    try:
+        app = QtGui.QGuiApplication([])
+        renderer = OffscreenRenderer(width, height)
+        # frames parsed as rendered, each by the worker rendering it
+        renderer.setFile(filename)
+        renderer.readFile()
+        worker = (app, renderer)
+    except Exception as e:
+        worker = RuntimeError("Could not start a rendering process: "
+                              + str(e))
+
+
+def renderChunk(args):
+    """Render frames in a worker process. Return their raw rgb24 data
+    if raw is True."""
+    if isinstance(worker, Exception):
+        raise worker
+    frames, pattern, raw = args
+    renderer = worker[1]
+    images = []
+    for frame in frames:
+        image = renderer.render(frame)
+        if pattern is not None:
+            saveImage(image, pattern, frame)
+        if raw:
+            images.append(rawRGB(image))
+    return images
+
+
+def renderFramesInParallel(filename, width, height, frames, pattern=None,
+                           pipe=None, processes=2, chunk_size=8):
+    """As renderFrames, with frames shared between processes rendering
+    chunks of chunk_size frames. frames is given as first:last:step.
+    The frames written to pipe keep their order."""
+    if filename == "-" or not os.path.isfile(filename):
+        raise ValueError("Rendering in parallel needs a regular file.")
+    start = time.time()
+
+    # index once here, the workers then read the index file
+    data = cFile.openFile(filename.encode("utf8"))
+    data.buildIndex()
+    frames = frameRange(frames, data.frame_nb())
+    chunks = [(frames[i:i+chunk_size], pattern, pipe is not None)
+              for i in range(0, len(frames), chunk_size)]
+
+    if pipe is not None:
+        encoder = subprocess.Popen(pipe, shell=True, stdin=subprocess.PIPE)
+    pool = multiprocessing.Pool(processes, initWorker,
+                                (filename, width, height))
+    # imap gives the chunks back in order
+    try:
+        for images in pool.imap(renderChunk, chunks):
+            for image in images:
+                encoder.stdin.write(image)
+    except BaseException:
+        pool.terminate()
+        if pipe is not None:
+            encoder.stdin.close()
+            encoder.wait()
+        raise
+    pool.close()
+    pool.join()
+    elapsed = time.time() - start
+
+    if pipe is not None:
+        encoder.stdin.close()
+        encoder.wait()
+    reportSpeed(len(frames), elapsed)
@@ -18,22 +18,64 @@
 import numpy as np
 
 
+class Labels:
+    """Labels of texts, as their UTF-8 bytes one after the other (uint8
+    array), and the offset of each label in them, followed by the end
+    of the last one. Labels are only decoded when asked one by one."""
+
+    def __init__(self, text, offsets):
+        self.text = text
+        self.offsets = offsets
+        self.nbytes = text.nbytes + offsets.nbytes
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.text[self.offsets[i]:self.offsets[i+1]].tobytes()\
+            .decode("utf8", "replace")
+
+    def lengths(self):
+        """Number of characters of each label."""
+        # characters start on any byte but UTF-8 continuation bytes
+        starts = np.r_[0, np.cumsum((self.text & 0xc0) != 0x80)]
+        return np.diff(starts[self.offsets])
+
+    def codePoints(self):
+        """Code points of all the characters of the labels."""
+        text = self.text.tobytes().decode("utf8", "replace")
+        return np.frombuffer(text.encode("utf-32-le"), dtype="<u4")
+
+
+def largestDimension(boundaries):
+    if boundaries is None:
+        return 0
+    return np.max(boundaries[:, 1] - boundaries[:, 0])
+
+
 class chochinScene:
 
-    def __init__(self, obj_vals, obj_attrs):
+    def __init__(self, obj_vals, obj_attrs, bounds=None):
+        """bounds, as given by getBoundaries, if already known."""
         self.obj_vals = obj_vals
         self.obj_attrs = obj_attrs
         self.rotated = False
+        self.bounds = bounds
+        self.largest_dimension = None
 
     def getBoundaries(self):
+        """[[xmin, xmax], [ymin, ymax], [zmin, zmax]] of the objects, or
+        None without objects. Computed once."""
+        if self.bounds is None:
+            self.bounds = self.computeBoundaries()
+        return self.bounds
+
+    def computeBoundaries(self):
         minima = None
         maxima = None
 
         for k in self.obj_vals:
-            if k != 't':
-                pos = self.obj_vals[k]
-            else:
-                pos = self.obj_vals[k][0]
+            pos = self.obj_vals[k]
             mink = np.min(np.reshape(pos, (-1, 3)),
                           axis=0)
             maxk = np.max(np.reshape(pos, (-1, 3)),
@@ -45,48 +87,34 @@ class chochinScene:
                 minima = np.minimum(minima, mink)
                 maxima = np.maximum(maxima, maxk)
 
+        if minima is None:
+            return None
         return np.column_stack((minima, maxima))
 
     def getLargestDimension(self):
-        boundaries = self.getBoundaries()
-        if boundaries[0, 0] is not None:
-            return np.max(boundaries[:, 1] - boundaries[:, 0])
-        else:
-            return 0
-
-    def filterLayers(self, layer_mask, object_layer_attr):
-        #  filter out layers
-        active_layers = np.nonzero(layer_mask)[0]
-        n = object_layer_attr.shape[0]
-        displayed_idx = np.zeros(n, dtype=np.bool)
-        for d in active_layers:
-            displayed_idx = np.logical_or(displayed_idx,
-                                          object_layer_attr == d)
-        return np.nonzero(displayed_idx)[0]
+        if self.largest_dimension is None:
+            self.largest_dimension = largestDimension(self.getBoundaries())
+        return self.largest_dimension
+
+    @staticmethod
+    def layerTable(layer_mask):
+        """Lookup table telling whether each layer (0 to 255) is shown,
+        from a mask over the first layers. Layers beyond the mask are
+        shown, as when drawing."""
+        table = np.ones(256, dtype=bool)
+        table[:len(layer_mask)] = layer_mask
+        return table
 
     def setRotation(self, rotation):
         self.rotation = rotation
         self.rotated = False
 
-    def rotate(self, positions):
-        dim = positions.shape[1]
-        if dim == 3:
-            rotated_pos = np.dot(positions, self.rotation)
-        if dim == 6:
-            rotated_pos = np.hstack((np.dot(positions[:, :3], self.rotation),
-                                     np.dot(positions[:, 3:6], self.rotation)))
-        self.rotated = True
-        return np.array(rotated_pos)  # dot sometimes returns a matrix!!! grrr
-
     def getDisplayedScene(self):
+        # objects, texts included, are rotated by the shaders
         displayed_pos = {}
         displayed_attrs = {}
         for k in self.obj_vals:
-            if k == "c":
-                displayed_pos[k] = self.obj_vals[k]
-                displayed_attrs[k] = self.obj_attrs[k]
-            else:
-                displayed_pos[k] = self.rotate(self.obj_vals[k])
-                displayed_attrs[k] = self.obj_attrs[k]
+            displayed_pos[k] = self.obj_vals[k]
+            displayed_attrs[k] = self.obj_attrs[k]
 
         return displayed_pos, displayed_attrs
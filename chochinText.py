@@ -0,0 +1,231 @@
+#    Copyright 2016 Romain Mari
+#    This file is part of Chochin.
+#
+#    Chochin is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Texts drawn by OpenGL, as instances of a quad per character, textured
+# from an atlas of the glyphs met so far.
+
+import threading
+import numpy as np
+import OpenGL.GL as gl
+
+from PyQt5 import QtGui, QtCore
+
+import chochinPrimitives as cPrim
+
+
+class GlyphAtlas:
+    """Glyphs of the characters met in the labels, drawn with a Qt font
+    in cells of an image, row after row. Glyphs are added from the
+    thread preparing frames, and the image is uploaded as a texture
+    when bound, so both are guarded by a lock."""
+    columns = 32
+
+    def __init__(self, font=None):
+        self.font = QtGui.QFont() if font is None else font
+        metrics = QtGui.QFontMetrics(self.font)
+        self.metrics = metrics
+        self.ascent = metrics.ascent()
+        self.descent = metrics.descent()
+        self.cell = (metrics.maxWidth(), metrics.height())
+        self.glyphs = {}        # atlas index, by code point
+        self.advances = []      # pixels, by atlas index
+        self.image = None
+        self.texture = None
+        self.texture_rows = 0   # rows of cells in the texture
+        self.changed = True
+        self.lock = threading.Lock()
+
+    def rows(self):
+        return self.image.height()//self.cell[1] if self.image else 0
+
+    def grow(self, glyph_nb):
+        """Make room for glyph_nb glyphs, keeping the glyphs drawn."""
+        rows = max(1, self.rows())
+        while rows*self.columns < glyph_nb:
+            rows *= 2
+        if rows == self.rows():
+            return
+        image = QtGui.QImage(self.columns*self.cell[0], rows*self.cell[1],
+                             QtGui.QImage.Format_RGBA8888)
+        image.fill(QtCore.Qt.transparent)
+        if self.image is not None:
+            painter = QtGui.QPainter(image)
+            painter.drawImage(0, 0, self.image)
+            painter.end()
+        self.image = image
+
+    def draw(self, chars):
+        """Add the glyphs of chars (code points) to the atlas."""
+        first = len(self.advances)
+        self.grow(first + len(chars))
+        painter = QtGui.QPainter(self.image)
+        painter.setFont(self.font)
+        painter.setPen(QtCore.Qt.white)
+        for k, c in enumerate(chars):
+            char = chr(c)
+            row, column = divmod(first + k, self.columns)
+            painter.drawText(column*self.cell[0],
+                             row*self.cell[1] + self.ascent, char)
+            self.glyphs[c] = first + k
+            self.advances.append(self.metrics.width(char))
+        painter.end()
+        self.changed = True
+
+    def glyphsOf(self, codes):
+        """Atlas indices and advances (in pixels) of the glyphs of code
+        points, drawing the new ones."""
+        chars, inverse = np.unique(codes, return_inverse=True)
+        with self.lock:
+            new = [int(c) for c in chars if int(c) not in self.glyphs]
+            if new:
+                self.draw(new)
+            indices = np.array([self.glyphs[int(c)] for c in chars],
+                               dtype=np.intp)
+            advances = np.array(self.advances, dtype=np.float32)
+        indices = indices[inverse]
+        return indices, advances[indices]
+
+    def bind(self, unit):
+        """Bind the atlas texture to a texture unit, uploading the
+        atlas if glyphs were added."""
+        gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+        if self.texture is None:
+            self.texture = gl.glGenTextures(1)
+            gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture)
+            for p in [gl.GL_TEXTURE_MIN_FILTER, gl.GL_TEXTURE_MAG_FILTER]:
+                gl.glTexParameteri(gl.GL_TEXTURE_2D, p, gl.GL_LINEAR)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture)
+        with self.lock:
+            if self.changed and self.image is not None:
+                bits = self.image.constBits()
+                bits.setsize(self.image.byteCount())
+                gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
+                gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA8,
+                                self.image.width(), self.image.height(), 0,
+                                gl.GL_RGBA, gl.GL_UNSIGNED_BYTE,
+                                np.frombuffer(bits, dtype=np.uint8))
+                self.texture_rows = self.rows()
+                self.changed = False
+
+
+class Texts(cPrim.ChochinPrimitiveArray):
+    t_vert = """
+    #version 120
+""" + cPrim.color_lookup + """
+    // Uniforms
+    uniform float u_scale;
+    uniform mat3 u_rotation;
+    uniform vec3 u_push;
+    uniform float u_port_size;  // pixels
+    uniform vec2 u_cell;        // glyph cell, pixels
+    uniform vec2 u_atlas;       // columns and rows of cells
+    uniform float u_descent;    // pixels below the baseline
+
+    // Attributes
+    // a_corner: corner of the shared quad, from (0, 0) to (1, 1); the
+    // others are per character
+    attribute vec2 a_corner;
+    attribute vec3 a_position;  // of the label
+    attribute float a_offset;   // of the character in the label, pixels
+    attribute float a_glyph;
+    attribute float a_color;
+
+    varying vec4 v_fg_color;
+    varying vec2 v_tex;
+
+    void main (void) {
+        v_fg_color = lookupColor(a_color);
+        vec2 cell = vec2(mod(a_glyph, u_atlas.x), floor(a_glyph/u_atlas.x));
+        // the first rows of the texture are the top of the atlas
+        v_tex = (cell + vec2(a_corner.x, 1.0 - a_corner.y))/u_atlas;
+        gl_Position = vec4((u_rotation*a_position+u_push)*u_scale,1.0);
+        vec2 pixels = vec2(a_offset, -u_descent) + a_corner*u_cell;
+        gl_Position.xy += 2.0*pixels/u_port_size;
+    }
+    """
+
+    t_frag = """
+    #version 120
+
+    uniform sampler2D u_glyphs;
+
+    varying vec4 v_fg_color;
+    varying vec2 v_tex;
+
+    void main()
+    {
+        float alpha = texture2D(u_glyphs, v_tex).a;
+        // no depth for the background of the glyphs
+        if (alpha < 0.05) {
+            discard;
+        }
+        gl_FragColor = vec4(v_fg_color.rgb, alpha*v_fg_color.a);
+    }
+    """
+
+    def __init__(self):
+        cPrim.ChochinPrimitiveArray.__init__(self,
+                                             self.t_vert,
+                                             self.t_frag,
+                                             gl.GL_TRIANGLES)
+        # characters are instances of a quad
+        self.attributes = ['a_corner']
+        self.instance_attributes = ['a_position', 'a_offset', 'a_glyph',
+                                    'a_color']
+        self.shape = cPrim.StreamBuffer()
+        self.shape.set_data(self.corners)
+
+    corners = np.array([[0, 0], [1, 0], [0, 1],
+                        [1, 0], [1, 1], [0, 1]], dtype=np.float32)
+
+    def set_atlas(self, atlas, unit=1):
+        atlas.bind(unit)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+        self.set_uniform('u_glyphs', unit)
+        self.set_uniform('u_cell', np.array(atlas.cell, dtype=np.float32))
+        self.set_uniform('u_atlas', np.array([atlas.columns,
+                                              atlas.texture_rows],
+                                             dtype=np.float32))
+        self.set_uniform('u_descent', atlas.descent)
+
+    @staticmethod
+    def vbo_data(positions, labels, colors, layers, atlas):
+        """One record per character, sorted by layer, and the number of
+        characters in each layer. labels as chochinScene.Labels."""
+        lengths = labels.lengths()
+        codes = labels.codePoints()
+        if len(codes) != lengths.sum():
+            # invalid UTF-8, where decoding changes the character count
+            labels = [labels[i] for i in range(len(labels))]
+            lengths = np.array([len(line) for line in labels], dtype=np.intp)
+            codes = np.frombuffer("".join(labels).encode("utf-32-le"),
+                                  dtype="<u4")
+        glyphs, advances = atlas.glyphsOf(codes)
+        label = np.repeat(np.arange(len(labels)), lengths)
+        # offset of each character from the start of its label
+        offsets = np.cumsum(advances) - advances
+        offsets -= offsets[np.repeat(np.cumsum(lengths) - lengths, lengths)]
+
+        # interleaved as label position, offset, glyph, color code
+        vbo_data = np.empty((len(codes), 6), dtype=np.float32)
+        vbo_data[:, :3] = positions[label]
+        vbo_data[:, 3] = offsets
+        vbo_data[:, 4] = glyphs
+        vbo_data[:, 5] = colors[label]
+        char_layers = layers[label]
+        order = np.argsort(char_layers, kind="mergesort")
+        return vbo_data[order], cPrim.layer_counts(char_layers)
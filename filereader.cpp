@@ -1,150 +1,1326 @@
 #include <vector>
 #include <unordered_map>
+#include <list>
 #include <fstream>
 #include <iostream>
 #include <sstream>
 #include <string>
+#include <memory>
+#include <stdexcept>
+#include <algorithm>
+#include <limits>
+#include <cstring>
+#include <cstdint>
+#include <sys/stat.h>
+#ifndef _WIN32
+#include <sys/mman.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <cerrno>
+#endif
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+#include <atomic>
+#include <deque>
+#include <exception>
+#include <zlib.h>
+
+struct FrameState {
+  int layer;
+  int color_index;   // palette index, or -1 for an explicit color
+  float color[4];    // rgba, used if color_index is -1
+  float thickness;
+};
+
+// Objects of one type, with one contiguous buffer per attribute
+struct Objects {
+  std::vector < float > positions;   // 3 (c, t) or 6 (s, l) per object
+  std::vector < uint16_t > colors;   // color codes, see colorCode()
+  std::vector < uint8_t > layers;
+  std::vector < float > radii;       // circles and sticks only
+};
 
 struct Frame {
-  std::unordered_map <std::string, std::vector < float > >  positions;
-  std::unordered_map <std::string, std::vector < float > > thicknesses;
-  std::unordered_map <std::string, std::vector < std::vector < float > > > colors;
-  std::unordered_map <std::string, std::vector < int > > layers;
-  std::unordered_map <std::string, std::vector < std::string > > texts;
+  struct Objects circles;
+  struct Objects sticks;
+  struct Objects lines;
+  struct Objects texts;
+  // labels of the texts, as UTF-8 text one after the other, with the
+  // offset of each label in it, and the end of the last one
+  std::vector < char > label_text;
+  std::vector < uint32_t > label_offsets;
+  struct FrameState state;      // state carried in at frame start
+  float bounds[6];              // xmin, ymin, zmin, xmax, ymax, zmax
+};
+
+
+// Record of the frame index, as stored in the index file
+struct IndexEntry {
+  int64_t offset;                // byte offset of the frame in the file
+  uint32_t object_nb[4];         // circles, sticks, lines, texts
+  struct FrameState state;       // state carried in at frame start
+};
+
+// Data file an index file was made from
+struct FileSignature {
+  uint64_t size;
+  int64_t mtime;                 // seconds
+  int64_t mtime_ns;              // and nanoseconds
+  uint64_t inode;
+};
+
+// Block of a BGZF file (gzip members of at most 64 kB of text, with
+// their compressed size in their header)
+struct GzipBlock {
+  std::size_t zoffset;           // compressed data (deflate stream)
+  std::size_t zsize;
+  std::size_t offset;            // offset of its text in the whole text
+  std::size_t size;
+};
+
+// Chunks of text passed from a decompressing thread to the thread
+// scanning them. The queue holds a few chunks at most, so that
+// decompression only runs a little ahead of scanning.
+class ChunkQueue {
+  std::deque < std::vector < char > > chunks;
+  std::mutex lock;
+  std::condition_variable changed;
+  bool closed;
+  std::exception_ptr error;
+  static const std::size_t max_chunks = 8;
+
+public:
+  ChunkQueue() : closed(false) {};
+
+  // Wait for some room, and return false if the queue was closed.
+  bool push(std::vector < char > &chunk) {
+    std::unique_lock < std::mutex > guard(lock);
+    changed.wait(guard, [this]() {
+      return closed || chunks.size() < max_chunks;
+    });
+    if (closed) {
+      return false;
+    }
+    chunks.push_back(std::move(chunk));
+    changed.notify_all();
+    return true;
+  };
+
+  // No more chunks, possibly because of an error, which is then
+  // raised by pop().
+  void close(std::exception_ptr e=std::exception_ptr()) {
+    std::lock_guard < std::mutex > guard(lock);
+    closed = true;
+    error = e;
+    changed.notify_all();
+  };
+
+  // Wait for a chunk, and return false once all of them were popped.
+  bool pop(std::vector < char > &chunk) {
+    std::unique_lock < std::mutex > guard(lock);
+    changed.wait(guard, [this]() { return closed || !chunks.empty(); });
+    if (!chunks.empty()) {
+      chunk = std::move(chunks.front());
+      chunks.pop_front();
+      changed.notify_all();
+      return true;
+    }
+    if (error) {
+      std::rethrow_exception(error);
+    }
+    return false;
+  };
 };
 
+static const char index_magic[8] = {'C', 'H', 'O', 'C', 'H', 'I', 'D', 'X'};
+static const uint32_t index_version = 2;
+// frames checked at most when loading the index of a BGZF file
+static const std::size_t index_samples = 64;
+
 
 class filereader {
 private:
-  std::ifstream in_file;
-  int layer;
-  std::vector < float > color; // rgba
-  float thickness;
-  // std::vector <struct Color> palette;
-  std::vector < std::vector < float > > palette;
+  std::string fname;
+  // file contents, either memory-mapped or read into buffer
+  const char *data;
+  std::size_t data_size;
+  bool mapped;
+  const char *map_data;
+  std::size_t map_size;
+  std::vector < char > buffer;
+  // Compressed files are decompressed in buffer (gzip), or block by
+  // block when frames are read (BGZF). data is then the text of gzip
+  // files, and is not used for BGZF files (data_size is their text
+  // size).
+  enum Compression {NONE, GZIP, BGZF} compression;
+  const char *zdata;
+  std::size_t zsize;
+  std::vector < char > zbuffer;      // compressed file read in memory
+  std::vector < struct GzipBlock > blocks;
+  bool inflated;                     // gzip text decompressed
+  // only regular files get an index file
+  bool regular_file;
+  // in follow mode, frames appended to the file are indexed by update()
+  bool follow;
+  // descriptor of a streamed input (pipe, FIFO, standard input), or -1
+  int stream_fd;
+  bool stream_end;
+  // progress of the index scan, so that it can go on with appended text
+  std::size_t scan_pos;              // start of the next line to scan
+  struct IndexEntry scan_entry;      // frame being scanned
+  struct FrameState scan_state;      // state at scan_pos
+  bool scan_empty;                   // no line yet in the scanned frame
+  bool scan_done;                    // an empty frame ended the file
+  // explicit colors met so far (rgba, 4 per color), and their codes.
+  // Shared by the threads parsing frames, so guarded by color_lock.
+  mutable std::vector < uint8_t > color_table;
+  mutable std::unordered_map < uint32_t, uint16_t > color_codes;
+  mutable std::mutex color_lock;
+  // where each frame starts, what it contains and the state carried in
+  std::vector < struct IndexEntry > frame_index;
+  // frames parsed so far, by frame index. Frames are shared with
+  // the arrays exposing them in Python, which may outlive the reader.
+  struct CachedFrame {
+    std::shared_ptr < struct Frame > frame;
+    std::size_t bytes;
+    std::list < std::size_t >::iterator age;
+  };
+  std::unordered_map < std::size_t, struct CachedFrame > frames;
+  // frame indices, most recently used first
+  std::list < std::size_t > frame_ages;
+  // memory taken by the cached frames, and its limit (0 for no limit)
+  std::size_t cache_bytes;
+  std::size_t cache_size;
+  // guards frames, as frames may be parsed while the GIL is released
+  std::mutex lock;
+
+  static const uint16_t explicit_color = 0x8000;
+  static const uint16_t color_cube = 0xf000;
+
+  // Color code of a state: its palette index, or explicit_color|k for
+  // the k-th color of color_table. Colors are resolved when drawn, so
+  // the palette can change without parsing again. Once color_table is
+  // full, colors are rounded to the codes from color_cube on, which
+  // stand for 8 levels of each of r, g, b and a.
+  uint16_t colorCode(const struct FrameState &state) const {
+    if (state.color_index >= 0) {
+      return state.color_index;
+    }
+    uint8_t rgba[4];
+    uint32_t key = 0;
+    for (int i = 0; i < 4; i++) {
+      float c = state.color[i] < 0 ? 0 : (state.color[i] > 1 ? 1 : state.color[i]);
+      rgba[i] = static_cast<uint8_t>(255*c + 0.5f);
+      key = key << 8 | rgba[i];
+    }
+    std::lock_guard < std::mutex > guard(color_lock);
+    auto code = color_codes.find(key);
+    if (code != color_codes.end()) {
+      return code->second;
+    }
+    std::size_t k = color_codes.size();
+    if (k < color_cube - explicit_color) {
+      color_codes[key] = explicit_color | k;
+      color_table.insert(color_table.end(), rgba, rgba+4);
+      return explicit_color | k;
+    }
+    uint16_t cube = 0;
+    for (int i = 0; i < 4; i++) {
+      cube = cube << 3 | (7*rgba[i] + 127)/255;
+    }
+    return color_cube | cube;
+  };
+
+  static bool isBlank(char c) {
+    return c == ' ' || c == '\t' || c == '\r' || c == '\v' || c == '\f';
+  };
+
+  static void skipBlanks(const char *&p, const char *end) {
+    while (p < end && isBlank(*p)) {
+      p++;
+    }
+  };
+
+  // Read a number at p and move p after it, or set ok to false (and
+  // return 0) if there is none. This works directly on the text, does
+  // not allocate and does not depend on the locale. Numbers with more
+  // significant digits or larger exponents than a double can represent
+  // exactly go through the standard library to keep the exact rounding.
+  static double parseNumber(const char *&p, const char *end, bool &ok) {
+    static const double powers[] = {1e0, 1e1, 1e2, 1e3, 1e4, 1e5, 1e6, 1e7,
+                                    1e8, 1e9, 1e10, 1e11, 1e12, 1e13, 1e14,
+                                    1e15, 1e16, 1e17, 1e18, 1e19, 1e20,
+                                    1e21, 1e22};
+    if (!ok) {
+      return 0;
+    }
+    skipBlanks(p, end);
+    const char *start = p;
+    bool negative = false;
+    if (p < end && (*p == '-' || *p == '+')) {
+      negative = (*p == '-');
+      p++;
+    }
+    uint64_t mantissa = 0;
+    int digits = 0;
+    int exponent = 0;
+    bool any_digit = false;
+    for (; p < end && *p >= '0' && *p <= '9'; p++) {
+      any_digit = true;
+      if (mantissa == 0 && *p == '0') {
+        continue;
+      }
+      if (digits < 19) {
+        mantissa = 10*mantissa + (*p - '0');
+      } else {
+        exponent++;
+      }
+      digits++;
+    }
+    if (p < end && *p == '.') {
+      p++;
+      for (; p < end && *p >= '0' && *p <= '9'; p++) {
+        any_digit = true;
+        if (mantissa == 0 && *p == '0') {
+          exponent--;
+          continue;
+        }
+        if (digits < 19) {
+          mantissa = 10*mantissa + (*p - '0');
+          exponent--;
+        }
+        digits++;
+      }
+    }
+    if (!any_digit) {
+      p = start;
+      ok = false;
+      return 0;
+    }
+    if (p < end && (*p == 'e' || *p == 'E')) {
+      const char *e = p + 1;
+      bool exp_negative = false;
+      if (e < end && (*e == '-' || *e == '+')) {
+        exp_negative = (*e == '-');
+        e++;
+      }
+      if (e < end && *e >= '0' && *e <= '9') {
+        int exp = 0;
+        for (; e < end && *e >= '0' && *e <= '9'; e++) {
+          if (exp < 100000) {
+            exp = 10*exp + (*e - '0');
+          }
+        }
+        exponent += exp_negative ? -exp : exp;
+        p = e;
+      }
+    }
+
+    double value;
+    if (mantissa == 0) {
+      value = 0;
+    } else if (mantissa < (uint64_t(1) << 53) && digits <= 19
+               && exponent >= -22 && exponent <= 22) {
+      value = static_cast<double>(mantissa);
+      value = exponent < 0 ? value / powers[-exponent] : value * powers[exponent];
+    } else {
+      std::istringstream number(std::string(start, p));
+      number >> value;
+      return value;
+    }
+    return negative ? -value : value;
+  };
+
+  // Pack the state color and layer as stored with the objects.
+  void packState(const struct FrameState &state, uint16_t &color,
+                 uint8_t &layer) const {
+    color = colorCode(state);
+    layer = state.layer < 0 ? 0 : (state.layer > 255 ? 255 : state.layer);
+  };
+
+  // Interpret a command changing the state, return false if cmd
+  // is not one of them. p points after the command.
+  bool setState(char cmd, const char *p, const char *end,
+                struct FrameState &state) const {
+    bool ok = true;
+    double value;
+    if (cmd == 'y') {
+      value = parseNumber(p, end, ok);
+      if (ok) {
+        state.layer = static_cast<int>(value);
+      }
+    } else if (cmd == '@') {
+      getColor(p, end, state);
+    } else if (cmd == 'r') {
+      value = parseNumber(p, end, ok);
+      if (ok) {
+        state.thickness = value;
+      }
+    } else {
+      return false;
+    }
+    return true;
+  };
+
+  // Parse the text of a frame. The frame does not depend on anything
+  // else than its text and the state carried in, which must be set in
+  // frame.state beforehand, so frames can be parsed in any order.
+  void parseFrame(const char *p, const char *end, struct Frame &frame) const {
+    struct FrameState state = frame.state;
+    uint16_t color;
+    uint8_t layer;
+    packState(state, color, layer);
+    while (p < end) {
+      const char *eol = static_cast<const char*>(std::memchr(p, '\n', end-p));
+      if (eol == NULL) {
+        eol = end;
+      }
+      if (eol == p) {               // empty line: end of frame
+        break;
+      }
+      const char *cmd = p;
+      skipBlanks(cmd, eol);
+      const char *args = cmd;
+      while (args < eol && !isBlank(*args)) {
+        args++;
+      }
+      bool known = (args - cmd == 1);
+      if (known) {
+        switch (*cmd) {
+          case 'c':
+            getCircle(args, eol, frame.circles, state.thickness, color, layer);
+            break;
+          case 's':
+            getString(args, eol, frame.sticks, state.thickness, color, layer);
+            break;
+          case 'l':
+            getLine(args, eol, frame.lines, color, layer);
+            break;
+          case 't':
+            getText(args, eol, frame, color, layer);
+            break;
+          default:
+            known = setState(*cmd, args, eol, state);
+            packState(state, color, layer);
+        }
+      }
+      if (!known && cmd != eol) {   // lines of blanks are ignored
+        std::cout << "[chochin] unrecognized command \""
+                  << std::string(p, eol) <<  "\"" << std::endl;
+      }
+      p = eol + 1;
+    }
+    setBounds(frame);
+  };
+
+  // Bounding box of the positions of all the objects of a frame, with
+  // the minima above the maxima for a frame without objects.
+  static void setBounds(struct Frame &frame) {
+    float *bounds = frame.bounds;
+    for (int i = 0; i < 3; i++) {
+      bounds[i] = std::numeric_limits<float>::infinity();
+      bounds[i+3] = -std::numeric_limits<float>::infinity();
+    }
+    for (const struct Objects *o: {&frame.circles, &frame.sticks,
+                                   &frame.lines, &frame.texts}) {
+      const float *x = o->positions.data();
+      for (std::size_t j = 0; j + 3 <= o->positions.size(); j += 3) {
+        for (int i = 0; i < 3; i++) {
+          bounds[i] = std::min(bounds[i], x[j+i]);
+          bounds[i+3] = std::max(bounds[i+3], x[j+i]);
+        }
+      }
+    }
+  };
+
+  // Text of frame i, from its start to the start of the next frame.
+  // The text of a BGZF file is decompressed in text.
+  void frameText(std::size_t i, const char *&begin, const char *&end,
+                 std::vector < char > &text) const {
+    std::size_t first = frame_index[i].offset;
+    std::size_t last = i + 1 < frame_index.size() ?
+                       frame_index[i+1].offset : data_size;
+    if (compression == BGZF) {
+      std::size_t start = inflateText(first, last, text);
+      begin = text.data() + (first - start);
+    } else {
+      begin = data + first;
+    }
+    end = begin + (last - first);
+  };
+
+  // Map the file in memory, so that the text is read directly from the
+  // page cache without copies.
+  // If the file was mapped already, it is mapped again with its
+  // current size.
+  bool mapFile() {
+#ifndef _WIN32
+    struct stat st;
+    if (stat(fname.c_str(), &st) != 0 || !S_ISREG(st.st_mode)
+        || st.st_size == 0) {
+      return false;
+    }
+    if (mapped) {
+      munmap(const_cast<char*>(map_data), map_size);
+      mapped = false;
+      data = NULL;
+      data_size = 0;
+    }
+    int fd = open(fname.c_str(), O_RDONLY);
+    if (fd < 0) {
+      return false;
+    }
+    void *map = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if (map == MAP_FAILED) {
+      return false;
+    }
+    map_data = data = static_cast<const char*>(map);
+    map_size = data_size = st.st_size;
+    mapped = true;
+    return true;
+#else
+    return false;
+#endif
+  };
+
+  // Read the whole file in memory, for inputs which cannot be mapped
+  // like pipes.
+  void readFile() {
+    std::ifstream in(fname.c_str(), std::ifstream::in | std::ifstream::binary);
+    if (!in.is_open()) {
+      throw std::runtime_error("Could not open file.\n ");
+    }
+    const std::size_t chunk = 1 << 20;
+    std::size_t size = 0;
+    while (in) {
+      buffer.resize(size + chunk);
+      in.read(buffer.data() + size, chunk);
+      size += in.gcount();
+    }
+    buffer.resize(size);
+    data = buffer.data();
+    data_size = size;
+  };
+
+  // Read what is available from the streamed input, waiting for it if
+  // needed. Return false at the end of the input.
+  bool readStream(std::vector < char > &chunk) {
+#ifndef _WIN32
+    chunk.resize(1 << 20);
+    ssize_t n;
+    do {
+      n = read(stream_fd, chunk.data(), chunk.size());
+    } while (n < 0 && errno == EINTR);
+    chunk.resize(n > 0 ? n : 0);
+    return n > 0;
+#else
+    return false;
+#endif
+  };
+
+  void appendStream(const std::vector < char > &chunk) {
+    buffer.insert(buffer.end(), chunk.begin(), chunk.end());
+    data = buffer.data();
+    data_size = buffer.size();
+  };
+
+  static std::size_t le16(const unsigned char *p) {
+    return p[0] | p[1] << 8;
+  };
+
+  static std::size_t le32(const unsigned char *p) {
+    return le16(p) | le16(p + 2) << 16;
+  };
+
+  // Set compression from the first bytes of the input. For compressed
+  // files, the input is moved to zdata.
+  void detectCompression() {
+    const unsigned char *z = reinterpret_cast<const unsigned char*>(data);
+    if (data_size >= 4
+        && z[0] == 0x28 && z[1] == 0xb5 && z[2] == 0x2f && z[3] == 0xfd) {
+      throw std::runtime_error("Zstandard compressed files are not "
+                               "supported, use gzip or bgzip.\n ");
+    }
+    if (data_size < 18 || z[0] != 0x1f || z[1] != 0x8b) {
+      return;
+    }
+    zdata = data;
+    zsize = data_size;
+    if (!mapped) {
+      zbuffer.swap(buffer);
+      zdata = zbuffer.data();
+    }
+    data = NULL;
+    data_size = 0;
+    compression = indexBlocks() ? BGZF : GZIP;
+  };
+
+  // Locate the blocks of a BGZF file from their headers, without
+  // decompressing them, and set data_size to the text size.
+  // Return false if this is not a BGZF file.
+  bool indexBlocks() {
+    blocks.clear();
+    const unsigned char *z = reinterpret_cast<const unsigned char*>(zdata);
+    std::size_t pos = 0, offset = 0;
+    while (pos < zsize) {
+      if (zsize - pos < 18 || z[pos] != 0x1f || z[pos+1] != 0x8b
+          || z[pos+2] != 8 || !(z[pos+3] & 4)) {
+        return false;
+      }
+      std::size_t xlen = le16(z + pos + 10);
+      if (pos + 12 + xlen > zsize) {
+        return false;
+      }
+      std::size_t block_size = 0;
+      for (std::size_t x = pos + 12; x + 4 <= pos + 12 + xlen;
+           x += 4 + le16(z + x + 2)) {
+        if (z[x] == 'B' && z[x+1] == 'C' && le16(z + x + 2) == 2
+            && x + 6 <= pos + 12 + xlen) {
+          block_size = le16(z + x + 4) + 1;
+        }
+      }
+      if (block_size < xlen + 20 || pos + block_size > zsize) {
+        return false;
+      }
+      struct GzipBlock block;
+      block.zoffset = pos + 12 + xlen;
+      block.zsize = block_size - xlen - 20;
+      block.offset = offset;
+      block.size = le32(z + pos + block_size - 4);
+      if (block.size > 0) {        // not the empty end-of-file block
+        blocks.push_back(block);
+      }
+      offset += block.size;
+      pos += block_size;
+    }
+    data_size = offset;
+    return true;
+  };
+
+  static void checkInflate(int ret) {
+    if (ret != Z_OK && ret != Z_STREAM_END && ret != Z_BUF_ERROR) {
+      throw std::runtime_error("Corrupted compressed file.\n ");
+    }
+  };
+
+  // Decompress a BGZF block to out, which has room for its text.
+  void inflateBlock(const struct GzipBlock &block, char *out) const {
+    z_stream stream;
+    std::memset(&stream, 0, sizeof(stream));
+    checkInflate(inflateInit2(&stream, -15));     // raw deflate
+    stream.next_in = reinterpret_cast<Bytef*>(const_cast<char*>(zdata
+                                                                + block.zoffset));
+    stream.avail_in = block.zsize;
+    stream.next_out = reinterpret_cast<Bytef*>(out);
+    stream.avail_out = block.size;
+    int ret = inflate(&stream, Z_FINISH);
+    inflateEnd(&stream);
+    if (ret != Z_STREAM_END || stream.total_out != block.size) {
+      throw std::runtime_error("Corrupted compressed file.\n ");
+    }
+  };
+
+  // Decompress the BGZF blocks holding the text from first to last
+  // in text, and return the offset at which text starts.
+  std::size_t inflateText(std::size_t first, std::size_t last,
+                          std::vector < char > &text) const {
+    struct GzipBlock key;
+    key.offset = first;
+    auto b = std::upper_bound(blocks.begin(), blocks.end(), key,
+                              [](const struct GzipBlock &a,
+                                 const struct GzipBlock &b) {
+                                return a.offset < b.offset;
+                              });
+    if (b != blocks.begin()) {
+      --b;
+    }
+    text.clear();
+    if (b == blocks.end()) {
+      return first;
+    }
+    std::size_t start = b->offset;
+    for (; b != blocks.end() && b->offset < last; ++b) {
+      text.resize(b->offset + b->size - start);
+      inflateBlock(*b, text.data() + (b->offset - start));
+    }
+    return start;
+  };
+
+  // Decompress the whole input to queue, by chunks of about 1 MB.
+  void inflateInput(ChunkQueue &queue) const {
+    const std::size_t chunk_size = 1 << 20;
+    std::vector < char > chunk;
+    if (compression == BGZF) {
+      for (const struct GzipBlock &block: blocks) {
+        std::size_t size = chunk.size();
+        chunk.resize(size + block.size);
+        inflateBlock(block, chunk.data() + size);
+        if (chunk.size() >= chunk_size && !queue.push(chunk)) {
+          return;
+        }
+      }
+    } else {
+      z_stream stream;
+      std::memset(&stream, 0, sizeof(stream));
+      checkInflate(inflateInit2(&stream, 15 + 16));   // gzip
+      std::size_t pos = 0;
+      while (true) {
+        if (stream.avail_in == 0) {     // avail_in is 32 bits only
+          stream.next_in = reinterpret_cast<Bytef*>(const_cast<char*>(zdata
+                                                                      + pos));
+          stream.avail_in = std::min(zsize - pos, std::size_t(1) << 30);
+          pos += stream.avail_in;
+        }
+        chunk.resize(chunk_size);
+        stream.next_out = reinterpret_cast<Bytef*>(chunk.data());
+        stream.avail_out = chunk_size;
+        int ret = inflate(&stream, Z_NO_FLUSH);
+        try {
+          checkInflate(ret);
+          if (ret == Z_BUF_ERROR && pos == zsize && stream.avail_in == 0) {
+            throw std::runtime_error("Truncated compressed file.\n ");
+          }
+        } catch (...) {
+          inflateEnd(&stream);
+          throw;
+        }
+        chunk.resize(chunk_size - stream.avail_out);
+        bool end = ret == Z_STREAM_END && stream.avail_in == 0
+          && pos == zsize;
+        if (ret == Z_STREAM_END && !end) {   // next gzip member
+          inflateReset(&stream);
+        }
+        if ((!chunk.empty() && !queue.push(chunk)) || end) {
+          break;
+        }
+      }
+      inflateEnd(&stream);
+    }
+    if (!chunk.empty()) {
+      queue.push(chunk);
+    }
+  };
+
+  // Decompress the input in another thread, scanning the text at the
+  // same time if scanning is true. The text of gzip files is kept in
+  // buffer.
+  void inflateAndScan(bool scanning) {
+    ChunkQueue queue;
+    std::thread inflater([this, &queue]() {
+      try {
+        inflateInput(queue);
+        queue.close();
+      } catch (...) {
+        queue.close(std::current_exception());
+      }
+    });
+    // BGZF text is only kept from the line being scanned
+    std::vector < char > window;
+    std::size_t window_offset = 0;
+    if (compression == GZIP) {
+      buffer.clear();
+      // the gzip trailer gives the text size modulo 2^32
+      buffer.reserve(le32(reinterpret_cast<const unsigned char*>(zdata)
+                          + zsize - 4));
+    }
+    try {
+      std::vector < char > chunk;
+      while (queue.pop(chunk)) {
+        if (compression == GZIP) {
+          appendStream(chunk);
+          if (scanning) {
+            scan(false);
+          }
+        } else {
+          window.erase(window.begin(),
+                       window.begin() + (scan_pos - window_offset));
+          window_offset = scan_pos;
+          window.insert(window.end(), chunk.begin(), chunk.end());
+          scanText(window.data(), window_offset, window.size(), false);
+        }
+      }
+    } catch (...) {
+      queue.close();
+      inflater.join();
+      throw;
+    }
+    inflater.join();
+    if (compression == GZIP) {
+      inflated = true;
+      if (scanning) {
+        scan(true);
+      }
+    } else {
+      scanText(window.data(), window_offset, window.size(), true);
+    }
+  };
+
+  static void reserve(struct Objects &objects, std::size_t n, int dim,
+                      bool radii) {
+    objects.positions.reserve(dim*n);
+    objects.colors.reserve(n);
+    objects.layers.reserve(n);
+    if (radii) {
+      objects.radii.reserve(n);
+    }
+  };
+
+  void prepareFrame(std::size_t i, struct Frame &frame) const {
+    const struct IndexEntry &entry = frame_index[i];
+    frame.state = entry.state;
+    reserve(frame.circles, entry.object_nb[0], 3, true);
+    reserve(frame.sticks, entry.object_nb[1], 6, true);
+    reserve(frame.lines, entry.object_nb[2], 6, false);
+    reserve(frame.texts, entry.object_nb[3], 3, false);
+    frame.label_offsets.reserve(entry.object_nb[3] + 1);
+    frame.label_offsets.assign(1, 0);
+  };
+
+  template < typename T >
+  static std::size_t vectorBytes(const std::vector < T > &v) {
+    return v.capacity()*sizeof(T);
+  };
+
+  static std::size_t frameBytes(const struct Frame &frame) {
+    std::size_t bytes = sizeof(struct Frame);
+    for (const struct Objects *o: {&frame.circles, &frame.sticks,
+                                   &frame.lines, &frame.texts}) {
+      bytes += vectorBytes(o->positions) + vectorBytes(o->colors)
+        + vectorBytes(o->layers) + vectorBytes(o->radii);
+    }
+    bytes += vectorBytes(frame.label_text) + vectorBytes(frame.label_offsets);
+    return bytes;
+  };
+
+  // Add a parsed frame to the cache, as the most recently used one.
+  void cacheFrame(std::size_t i, std::shared_ptr < struct Frame > frame) {
+    frame_ages.push_front(i);
+    struct CachedFrame &cached = frames[i];
+    cached.frame = frame;
+    cached.bytes = frameBytes(*frame);
+    cached.age = frame_ages.begin();
+    cache_bytes += cached.bytes;
+  };
+
+  std::shared_ptr < struct Frame > cachedFrame(std::size_t i) {
+    auto f = frames.find(i);
+    if (f == frames.end()) {
+      return std::shared_ptr < struct Frame > ();
+    }
+    frame_ages.splice(frame_ages.begin(), frame_ages, f->second.age);
+    return f->second.frame;
+  };
+
+  // Drop the least recently used frames until the cache fits in
+  // cache_size, keeping at least the most recent one.
+  void trimCache() {
+    while (cache_size > 0 && cache_bytes > cache_size
+           && frame_ages.size() > 1) {
+      auto f = frames.find(frame_ages.back());
+      cache_bytes -= f->second.bytes;
+      frames.erase(f);
+      frame_ages.pop_back();
+    }
+  };
+
+  void clearCache() {
+    frames.clear();
+    frame_ages.clear();
+    cache_bytes = 0;
+  };
+
+  // Index files are named after the data file and keyed by its size,
+  // modification time (to the nanosecond where available) and inode.
+  std::string indexFileName() {
+    return fname + ".chidx";
+  };
+
+  bool fileSignature(struct FileSignature &signature) {
+    struct stat st;
+    if (stat(fname.c_str(), &st) != 0) {
+      return false;
+    }
+    signature.size = st.st_size;
+    signature.mtime = st.st_mtime;
+#if defined(__APPLE__)
+    signature.mtime_ns = st.st_mtimespec.tv_nsec;
+#elif defined(_WIN32)
+    signature.mtime_ns = 0;
+#else
+    signature.mtime_ns = st.st_mtim.tv_nsec;
+#endif
+    signature.inode = st.st_ino;
+    return true;
+  };
+
+  bool loadIndex() {
+    struct FileSignature signature, idx_signature;
+    if (!regular_file || !fileSignature(signature)) {
+      return false;
+    }
+    std::ifstream idx_file(indexFileName().c_str(), std::ifstream::binary);
+    if (!idx_file.is_open()) {
+      return false;
+    }
+    char magic[8];
+    uint32_t version;
+    uint64_t entry_nb;
+    idx_file.read(magic, 8);
+    idx_file.read(reinterpret_cast<char*>(&version), sizeof(version));
+    idx_file.read(reinterpret_cast<char*>(&idx_signature),
+                  sizeof(idx_signature));
+    idx_file.read(reinterpret_cast<char*>(&entry_nb), sizeof(entry_nb));
+    if (!idx_file
+        || !std::equal(magic, magic+8, index_magic)
+        || version != index_version
+        || idx_signature.size != signature.size
+        || idx_signature.mtime != signature.mtime
+        || idx_signature.mtime_ns != signature.mtime_ns
+        || idx_signature.inode != signature.inode
+        || entry_nb > signature.size) {
+      return false;
+    }
+    frame_index.resize(entry_nb);
+    idx_file.read(reinterpret_cast<char*>(frame_index.data()),
+                  entry_nb*sizeof(struct IndexEntry));
+    if (!idx_file) {
+      frame_index.clear();
+      return false;
+    }
+    return true;
+  };
+
+  // Whether the frames of the loaded index start where the scan would
+  // find them: offsets increasing within the text, and each frame but
+  // the first after an empty line. Only a sample of the frames is
+  // checked in BGZF files, whose text would have to be decompressed.
+  bool checkIndex() const {
+    std::size_t n = frame_index.size();
+    if (n > 0 && frame_index[0].offset != 0) {
+      return false;
+    }
+    for (std::size_t i = 1; i < n; i++) {
+      if (frame_index[i].offset <= frame_index[i-1].offset) {
+        return false;
+      }
+    }
+    if (n > 0 && static_cast<uint64_t>(frame_index[n-1].offset)
+                 >= data_size) {
+      return false;
+    }
+    std::size_t step = 1;
+    if (compression == BGZF) {
+      step = std::max < std::size_t > (1, n/index_samples);
+    }
+    std::vector < char > text;
+    for (std::size_t i = 1; i < n; i += step) {
+      if (!frameStartsAt(frame_index[i].offset, text)) {
+        return false;
+      }
+    }
+    return n < 2 || frameStartsAt(frame_index[n-1].offset, text);
+  };
+
+  bool frameStartsAt(std::size_t offset, std::vector < char > &text) const {
+    if (offset < 2) {
+      return false;
+    }
+    const char *before = data + offset - 2;
+    if (compression == BGZF) {
+      std::size_t start = inflateText(offset - 2, offset, text);
+      if (start + text.size() < offset) {
+        return false;
+      }
+      before = text.data() + (offset - 2 - start);
+    }
+    return before[0] == '\n' && before[1] == '\n';
+  };
+
+  void saveIndex() {
+    struct FileSignature signature;
+    if (!regular_file || !fileSignature(signature)) {
+      return;
+    }
+    std::ofstream idx_file(indexFileName().c_str(), std::ofstream::binary);
+    if (!idx_file.is_open()) {
+      std::cout << "[chochin] could not write index file "
+                << indexFileName() << std::endl;
+      return;
+    }
+    uint64_t entry_nb = frame_index.size();
+    idx_file.write(index_magic, 8);
+    idx_file.write(reinterpret_cast<const char*>(&index_version),
+                   sizeof(index_version));
+    idx_file.write(reinterpret_cast<const char*>(&signature),
+                   sizeof(signature));
+    idx_file.write(reinterpret_cast<const char*>(&entry_nb), sizeof(entry_nb));
+    idx_file.write(reinterpret_cast<const char*>(frame_index.data()),
+                   entry_nb*sizeof(struct IndexEntry));
+  };
+
+  // Account for a non-empty line of the frame being indexed: count the
+  // objects and follow the state changes.
+  void indexLine(const char *begin, const char *end, struct IndexEntry &entry,
+                 struct FrameState &state) {
+    skipBlanks(begin, end);
+    if (begin == end || (begin + 1 < end && !isBlank(begin[1]))) {
+      return;
+    }
+    switch (*begin) {
+      case 'c': entry.object_nb[0]++; break;
+      case 's': entry.object_nb[1]++; break;
+      case 'l': entry.object_nb[2]++; break;
+      case 't': entry.object_nb[3]++; break;
+      default: setState(*begin, begin + 1, end, state);
+    }
+  };
+
+  void startIndexEntry(std::size_t offset) {
+    scan_entry.offset = offset;
+    std::fill(scan_entry.object_nb, scan_entry.object_nb+4, 0);
+    scan_entry.state = scan_state;
+    scan_empty = true;
+  };
+
+  void resetScan() {
+    frame_index.clear();
+    scan_pos = 0;
+    scan_state = {1, -1, {0, 0, 0, 0}, 1};
+    startIndexEntry(0);
+    scan_done = false;
+  };
+
+  // Find where the frames start with a single pass over the file,
+  // looking for the empty lines separating frames. Objects are only
+  // counted, and the commands changing the state are followed to know
+  // the state at the start of every frame.
+  // As for a sequential read, an empty frame ends the file.
+  // The scan starts where the previous one stopped. Unless final is
+  // true, it stops at the last complete line, and the last frame is
+  // only indexed once the empty line closing it has been seen.
+  void scan(bool final) {
+    scanText(data, 0, data_size, final);
+  };
+
+  // Scan text, which holds the input from text_offset on, for
+  // text_size bytes, and at least from scan_pos.
+  void scanText(const char *text, std::size_t text_offset,
+                std::size_t text_size, bool final) {
+    const char *end = text + text_size;
+    const char *l = text + (scan_pos - text_offset);
+    while (!scan_done && l < end) {
+      const char *nl = static_cast<const char*>(std::memchr(l, '\n', end-l));
+      if (nl == NULL) {
+        if (!final) {                // incomplete line
+          break;
+        }
+        nl = end;
+      }
+      if (l != nl) {
+        indexLine(l, nl, scan_entry, scan_state);
+        scan_empty = false;
+      } else if (scan_empty) {       // empty frame: end of file
+        scan_done = true;
+      } else {                       // empty line: end of frame
+        frame_index.push_back(scan_entry);
+        startIndexEntry(text_offset + (nl + 1 - text));
+      }
+      l = nl < end ? nl + 1 : end;
+    }
+    scan_pos = text_offset + (l - text);
+    if (final && !scan_done) {
+      if (!scan_empty) {
+        frame_index.push_back(scan_entry);
+      }
+      scan_done = true;
+    }
+  };
 
 public:
-  // std::map <std::string, std::vector < std::vector < float > > > positions;
-  std::vector < struct Frame > frames;
-  filereader(std::string fname) :
-  layer(1),
-  color({0,0,0,0}),
-  thickness(1)
+  // fname "-" is the standard input. If follow_file is true, the file
+  // is expected to grow and frames appended to it are taken into
+  // account by update().
+  filereader(std::string file_name, bool follow_file=false) :
+  fname(file_name),
+  data(NULL),
+  data_size(0),
+  mapped(false),
+  map_data(NULL),
+  map_size(0),
+  compression(NONE),
+  zdata(NULL),
+  zsize(0),
+  inflated(false),
+  regular_file(false),
+  follow(follow_file),
+  stream_fd(-1),
+  stream_end(false),
+  cache_bytes(0),
+  cache_size(0)
   {
-    in_file.open(fname.c_str(), std::ifstream::in);
-    if (!in_file.is_open()) {
-      throw std::runtime_error("Could not open file.\n ");
+    if (fname == "-") {
+      stream_fd = 0;
+    } else {
+      struct stat st;
+      if (stat(fname.c_str(), &st) != 0) {
+        throw std::runtime_error("Could not open file.\n ");
+      }
+      regular_file = S_ISREG(st.st_mode);
+      if (regular_file) {
+        if (!mapFile() && !follow) {
+          readFile();
+        }
+      } else {
+#ifndef _WIN32
+        stream_fd = open(fname.c_str(), O_RDONLY);
+#endif
+        if (stream_fd < 0) {
+          throw std::runtime_error("Could not open file.\n ");
+        }
+      }
+    }
+    if (stream_fd >= 0 && !follow) {
+      std::vector < char > chunk;
+      while (readStream(chunk)) {
+        appendStream(chunk);
+      }
+      stream_end = true;
     }
+    if (!follow) {
+      detectCompression();
+    }
+    resetScan();
   };
   ~filereader(){
-    in_file.close();
+#ifndef _WIN32
+    if (mapped) {
+      munmap(const_cast<char*>(map_data), map_size);
+    }
+    if (stream_fd > 0) {
+      close(stream_fd);
+    }
+#endif
   };
 
-  void setPalette(const std::vector < std::vector < float > > &color_palette){
-    palette = color_palette;
-    // for (auto p: palette){
-    //   std::cout << p[0] << " " <<  p[1] << " " << p[2] << " " << p[3]  << std::endl;
-    // }
-  }
+  // Explicit colors (rgba) from the first-th one on. Colors are only
+  // ever added to the table, so only the new ones need to be asked for.
+  std::vector < uint8_t > colorTable(std::size_t first) {
+    std::lock_guard < std::mutex > guard(color_lock);
+    if (4*first >= color_table.size()) {
+      return std::vector < uint8_t > ();
+    }
+    return std::vector < uint8_t > (color_table.begin() + 4*first,
+                                    color_table.end());
+  };
 
-  void getCircle(std::istringstream &sline, struct Frame &frame) {
-    double coord;
-    for (int i=0; i < 3; i++) {
-      sline >> coord;
-      frame.positions["c"].push_back(coord);
+  // Locate the frames in the file. The index file is used if it is up
+  // to date, otherwise the file is scanned and the index file written.
+  // Nothing is parsed here, frames are read on demand by getFrame().
+  // Compressed files are decompressed in another thread while the
+  // text is scanned.
+  void index() {
+    std::lock_guard < std::mutex > guard(lock);
+    clearCache();
+    bool indexed = !follow && loadIndex();
+    if (indexed && compression == GZIP && !inflated) {
+      inflateAndScan(false);
+    }
+    if (indexed && !checkIndex()) {
+      indexed = false;
+    }
+    if (!indexed) {
+      resetScan();
+    }
+    if ((compression == GZIP && !inflated) || (compression == BGZF
+                                                && !indexed)) {
+      inflateAndScan(!indexed);
+    } else if (!indexed) {
+      scan(!follow);
+    }
+    if (!indexed && !follow) {
+      saveIndex();
     }
-    frame.thicknesses["c"].push_back(thickness);
-    frame.colors["c"].push_back(color);
-    frame.layers["c"].push_back(layer);
   };
 
-  void getLine(std::istringstream &sline, struct Frame &frame) {
-    double coord;
-    for (int i=0; i < 6; i++) {
-      sline >> coord;
-      frame.positions["l"].push_back(coord);
+  // In follow mode, index the frames appended since the last call,
+  // and return how many there are. A streamed input is waited for
+  // until some data arrive.
+  std::size_t update() {
+    if (!follow) {
+      return 0;
+    }
+    std::vector < char > chunk;
+    bool more = true;
+    if (stream_fd >= 0 && !stream_end) {
+      more = readStream(chunk);
     }
-    frame.colors["l"].push_back(color);
-    frame.layers["l"].push_back(layer);
+    std::lock_guard < std::mutex > guard(lock);
+    std::size_t frame_nb = frame_index.size();
+    if (stream_fd >= 0) {
+      appendStream(chunk);
+      stream_end = !more;
+    } else {
+      struct stat st;
+      if (stat(fname.c_str(), &st) == 0
+          && static_cast<std::size_t>(st.st_size) > data_size
+          && !mapFile()) {
+        throw std::runtime_error("Could not map file.\n ");
+      }
+    }
+    scan(stream_end);
+    return frame_index.size() - frame_nb;
   };
 
-  void getString(std::istringstream &sline, struct Frame &frame) {
-    double coord;
-    for (int i=0; i < 6; i++) {
-      sline >> coord;
-      frame.positions["s"].push_back(coord);
+  // True when a streamed input was read to its end.
+  bool atEnd() {
+    return stream_end;
+  };
+
+  // Parse the frames first to last-1 which were not parsed yet, with
+  // nthreads threads. The frames are split between threads as they
+  // become available.
+  // As each frame starts from the state given by the index, this gives
+  // the same frames as parsing them one after the other.
+  void load(std::size_t first, std::size_t last, unsigned nthreads) {
+    std::lock_guard < std::mutex > guard(lock);
+    last = std::min(last, frame_index.size());
+    std::vector < std::pair < std::size_t, std::shared_ptr < struct Frame > > > todo;
+    for (std::size_t i = first; i < last; i++) {
+      if (!cachedFrame(i)) {
+        std::shared_ptr < struct Frame > frame = std::make_shared < struct Frame > ();
+        prepareFrame(i, *frame);
+        todo.emplace_back(i, frame);
+      }
+    }
+
+    std::atomic < std::size_t > next(0);
+    auto worker = [&]() {
+      const char *begin, *end;
+      std::vector < char > text;
+      for (std::size_t k; (k = next++) < todo.size(); ) {
+        frameText(todo[k].first, begin, end, text);
+        parseFrame(begin, end, *todo[k].second);
+      }
+    };
+    std::vector < std::thread > pool;
+    for (unsigned t = 1; t < nthreads && t < todo.size(); t++) {
+      pool.emplace_back(worker);
+    }
+    worker();
+    for (auto &t: pool) {
+      t.join();
+    }
+    for (auto &f: todo) {
+      cacheFrame(f.first, f.second);
+    }
+    trimCache();
+  };
+
+  // Limit the memory taken by the parsed frames kept in memory to
+  // about bytes, dropping the least recently used ones (0 for no
+  // limit, the default).
+  void setCacheSize(std::size_t bytes) {
+    std::lock_guard < std::mutex > guard(lock);
+    cache_size = bytes;
+    trimCache();
+  };
+
+  std::size_t frameNumber() {
+    std::lock_guard < std::mutex > guard(lock);
+    return frame_index.size();
+  };
+
+  // Parse frame i if it was not already, and return it.
+  std::shared_ptr < struct Frame > getFrame(std::size_t i) {
+    std::lock_guard < std::mutex > guard(lock);
+    if (i >= frame_index.size()) {
+      throw std::out_of_range("Frame index out of range.");
     }
-    frame.thicknesses["s"].push_back(thickness);
-    frame.colors["s"].push_back(color);
-    frame.layers["s"].push_back(layer);
+    std::shared_ptr < struct Frame > frame = cachedFrame(i);
+    if (frame) {
+      return frame;
+    }
+    const char *begin, *end;
+    std::vector < char > text;
+    frameText(i, begin, end, text);
+    frame = std::make_shared < struct Frame > ();
+    prepareFrame(i, *frame);
+    parseFrame(begin, end, *frame);
+    cacheFrame(i, frame);
+    trimCache();
+    return frame;
+  };
+
+  static void addObject(struct Objects &objects, uint16_t color,
+                        uint8_t layer) {
+    objects.colors.push_back(color);
+    objects.layers.push_back(layer);
   };
 
-  void getText(std::istringstream &sline, struct Frame &frame) {
-    double coord;
+  void getCircle(const char *p, const char *end, struct Objects &circles,
+                 float radius, uint16_t color, uint8_t layer) const {
+    bool ok = true;
     for (int i=0; i < 3; i++) {
-      sline >> coord;
-      frame.positions["t"].push_back(coord);
+      circles.positions.push_back(parseNumber(p, end, ok));
     }
-    frame.colors["t"].push_back(color);
-    frame.layers["t"].push_back(layer);
-    std::string t;
-    std::getline(sline, t);
-    frame.texts["t"].push_back(t);
+    circles.radii.push_back(radius);
+    addObject(circles, color, layer);
   };
 
-  void getColor(std::istringstream &sline) {
-    std::string line;
-    std::getline(sline, line);
-    std::istringstream remaining(line);
-    float component;
-    std::vector<float> col;
-    while(remaining >> component) {
-      col.push_back(component);
+  void getLine(const char *p, const char *end, struct Objects &lines,
+               uint16_t color, uint8_t layer) const {
+    bool ok = true;
+    for (int i=0; i < 6; i++) {
+      lines.positions.push_back(parseNumber(p, end, ok));
     }
+    addObject(lines, color, layer);
+  };
 
-    if (col.size() == 1) {           // by label
-      color = palette[col[0]];
-    } else if (col.size() == 3) {    // by rgb
-      col.push_back(1);
-      color = col;
-    } else if (col.size() == 4) {    // by rgba
-      color = col;
+  void getString(const char *p, const char *end, struct Objects &sticks,
+                 float radius, uint16_t color, uint8_t layer) const {
+    bool ok = true;
+    for (int i=0; i < 6; i++) {
+      sticks.positions.push_back(parseNumber(p, end, ok));
     }
+    sticks.radii.push_back(radius);
+    addObject(sticks, color, layer);
   };
 
-  bool get(){
-    std::string cmd;
-    struct Frame frame;
-    frames.push_back(frame);
+  void getText(const char *p, const char *end, struct Frame &frame,
+               uint16_t color, uint8_t layer) const {
+    bool ok = true;
+    for (int i=0; i < 3; i++) {
+      frame.texts.positions.push_back(parseNumber(p, end, ok));
+    }
+    addObject(frame.texts, color, layer);
+    // the text is the rest of the line
+    frame.label_text.insert(frame.label_text.end(), ok ? p : end, end);
+    frame.label_offsets.push_back(frame.label_text.size());
+  };
 
-    bool empty = true;
-    for (std::string line; std::getline(in_file, line); ) {
-      if (line.empty()) {
-        break;
+  void getColor(const char *p, const char *end, struct FrameState &state) const {
+    bool ok = true;
+    float col[4];
+    int n = 0;
+    for (double c = parseNumber(p, end, ok); ok; c = parseNumber(p, end, ok), n++) {
+      if (n < 4) {
+        col[n] = c;
       }
-      empty = false;
-      std::istringstream sline(line);
-      sline >> cmd;
-      struct Frame &new_frame = frames[frames.size()-1];
-      if (cmd == "c") {
-        getCircle(sline, new_frame);
-      } else if (cmd == "s") {
-        getString(sline, new_frame);
-      } else if (cmd == "l") {
-        getLine(sline, new_frame);
-      } else if (cmd == "t") {
-        getText(sline, new_frame);
-      } else if (cmd == "y") {
-        sline >> layer;
-      } else if (cmd == "@") {
-        getColor(sline);
-      } else if (cmd == "r") {
-        sline >> thickness;
-      } else {
-        std::cout << "[chochin] unrecognized command \"" << line <<  "\"" << std::endl;
+    }
+
+    if (n == 1) {                    // by label
+      if (col[0] >= 0 && col[0] < explicit_color) {
+        state.color_index = col[0];
       }
+    } else if (n == 3) {             // by rgb
+      col[3] = 1;
+      std::copy(col, col+4, state.color);
+      state.color_index = -1;
+    } else if (n == 4) {             // by rgba
+      std::copy(col, col+4, state.color);
+      state.color_index = -1;
     }
-    return !empty;
   };
-
 };
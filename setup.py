@@ -6,7 +6,9 @@ from Cython.Build import cythonize
 chochinFile_module = Extension('chochinFile',
                                sources=['chochinFile.pyx'],
                                language="c++",
-                               extra_compile_args=["-std=c++11"])
+                               extra_compile_args=["-std=c++11", "-pthread"],
+                               extra_link_args=["-pthread"],
+                               libraries=["z"])
 
 setup(
   ext_modules=cythonize(chochinFile_module),